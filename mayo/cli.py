@@ -3,7 +3,6 @@ import sys
 import base64
 
 import yaml
-import tensorflow as tf
 
 from docopt import docopt
 
@@ -168,26 +167,70 @@ Arguments:
         return self.session
 
     def cli_profile_timeline(self):
-        """Performs training profiling to produce timeline.json.  """
-        # TODO integrate this into Profile.
-        from tensorflow.python.client import timeline
-        options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
-        run_metadata = tf.RunMetadata()
+        """Performs training profiling to produce traces of steps.  """
         session = self._get_session('train')
+        tracer = session.tracer
         # run 100 iterations to warm up
         max_iterations = 100
         for i in range(max_iterations):
             log.info(
                 'Running {}/{} iterations to warm up...'
                 .format(i, max_iterations), update=True)
-            session.run(session._train_op)
-        log.info('Running the final iteration to generate timeline...')
-        session.run(
-            session._train_op, options=options, run_metadata=run_metadata)
-        fetched_timeline = timeline.Timeline(run_metadata.step_stats)
-        chrome_trace = fetched_timeline.generate_chrome_trace_format()
-        with open('timeline.json', 'w') as f:
-            f.write(chrome_trace)
+            session.run(session._train_op, batch=True)
+        log.info('Running {} iterations to trace...'.format(tracer.window))
+        tracer.interval = 1
+        for i in range(tracer.window):
+            session.run(session._train_op, batch=True)
+        tracer.save()
+        log.info('Traces and layer costs saved in {!r}.'.format(tracer.path))
+
+    def cli_pack_dataset(self):
+        """Converts TFRecord datasets into packed memory-mapped arrays.  """
+        from mayo.task.image.generate import Preprocess
+        from mayo.task.image.packed import pack
+        self._validate_config(self._dataset_keys, 'pack-dataset')
+        shape = self.config.dataset.task.shape
+        shape = (shape.height, shape.width, shape.channels)
+        for mode in ('train', 'validate'):
+            files = self.config.data_files(mode)
+            path = os.path.join(
+                os.path.dirname(files[0]), '{}.packed'.format(mode))
+            pack(files, path, shape, Preprocess._parse_proto)
+
+    def cli_bench_input(self):
+        """Benchmarks the throughput of the input pipeline.  """
+        from mayo.util import object_from_params
+        from mayo.task.image.generate import Preprocess
+        from mayo.task.image.bench import bench_input
+        self._validate_config(self._dataset_keys, 'bench-input')
+        mode = self.config.get('bench.mode', 'train')
+        dataset = self.config.dataset
+        task_cls, params = object_from_params(dataset.task)
+        preprocess = params['preprocess']
+        preprocessor = Preprocess(
+            self.config.system, mode, task_cls._truth_keys,
+            self.config.data_files(mode), preprocess, params['shape'],
+            preprocess['shape'], params.get('moment'),
+            dataset.num_examples_per_epoch[mode],
+            dataset.get('format', 'tfrecord'))
+        num_threads = self.config.system.preprocess.num_threads
+        table = bench_input(
+            preprocessor,
+            self.config.get('bench.num_threads', [num_threads]),
+            self.config.get('bench.prefetch', [None]),
+            self.config.get('bench.num_batches', 50))
+        print(table.format())
+        return table
+
+    def cli_bench_sparse(self):
+        """Benchmarks dense and sparse layers with pruned weights on CPU.  """
+        from mayo.net.tf.sparse import bench_sparse
+        table = bench_sparse(
+            self._get_session('validate'),
+            self.config.get('bench.batch_size', 1),
+            self.config.get('bench.num_runs', 20))
+        print(table.format())
+        return table
 
     def cli_plot(self):
         """Plots activation maps as images and parameters as histograms."""
@@ -239,6 +282,18 @@ Arguments:
         """Export the internal parameters of overriders.  """
         self._get_session().overriders_dump()
 
+    def cli_compact(self):
+        """Removes pruned channels to export a smaller model.  """
+        model = self._get_session('validate').compact()
+        name = 'compact.yaml'
+        with open(name, 'w') as f:
+            yaml.dump(
+                {'model': model}, f,
+                explicit_start=True, width=70, indent=4)
+        log.info(
+            'Compacted model saved in {!r}, load it with the checkpoint '
+            '"compact".'.format(name))
+
     def cli_reset_num_epochs(self):
         """Resets the number of training epochs.  """
         self._get_session('train').reset_num_epochs()
@@ -7,13 +7,200 @@ from mayo.log import log
 from mayo.util import Change
 
 
+class History(object):
+    """
+    A ring buffer of statistic values preallocated as a numpy array, which
+    keeps a running mean and sum of squared deviations (Welford's method)
+    for O(1) mean and standard deviation.
+
+    capacity:
+        the number of most recent values to keep; if it is None, the buffer
+        grows and no values are discarded.
+    """
+    initial_capacity = 16
+
+    def __init__(self, capacity=None):
+        super().__init__()
+        self.capacity = capacity
+        self._buffer = None
+        self._start = self._length = 0
+        # running statistics, None if values are not numeric
+        self._mean = self._deviations = 0.0
+        self._size = 0
+        self._evictions = 0
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for index in range(self._length):
+            yield self[index]
+
+    def __array__(self, dtype=None):
+        if not self._length:
+            return np.array([], dtype=dtype)
+        return np.asarray(self._buffer[self._indices()], dtype=dtype)
+
+    def _indices(self, index=None):
+        if self._buffer is None:
+            raise IndexError('History is empty.')
+        length = len(self._buffer)
+        if index is None:
+            return (self._start + np.arange(self._length)) % length
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError('History index out of range.')
+        return (self._start + index) % length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._length))]
+        value = self._buffer[self._indices(index)]
+        if isinstance(value, np.ndarray):
+            # avoid aliasing slots that will be overwritten
+            value = value.copy()
+        return value
+
+    def __setitem__(self, index, value):
+        if index < 0:
+            index += self._length
+        self._accumulate(self._buffer[self._indices(index)], -1)
+        self._store(index, value)
+        self._accumulate(value, 1)
+
+    @staticmethod
+    def _numeric(value):
+        try:
+            value = np.asarray(value)
+        except ValueError:
+            return None
+        if value.dtype.kind not in 'biuf':
+            return None
+        return value
+
+    def _accumulate(self, value, sign):
+        # merges (sign=1) or removes (sign=-1) the statistics of `value`
+        # with Chan's parallel variant of Welford's method
+        if self._mean is None:
+            return
+        value = self._numeric(value)
+        if value is None:
+            self._mean = self._deviations = None
+            return
+        value = value.astype(np.float64)
+        count = value.size
+        if not count:
+            return
+        mean = np.mean(value)
+        deviations = np.sum(np.square(value - mean))
+        size = self._size + sign * count
+        if size <= 0:
+            self._mean = self._deviations = 0.0
+            self._size = 0
+            return
+        if sign > 0:
+            delta = mean - self._mean
+            self._mean += delta * count / size
+            self._deviations += \
+                deviations + delta * delta * self._size * count / size
+        else:
+            new_mean = (self._size * self._mean - count * mean) / size
+            delta = mean - new_mean
+            self._deviations -= \
+                deviations + delta * delta * size * count / self._size
+            self._mean = new_mean
+        self._size = size
+
+    def _recompute(self):
+        # exact statistics of the buffer, to discard errors accumulated
+        # from removals
+        self._mean = self._deviations = 0.0
+        self._size = 0
+        for value in self:
+            self._accumulate(value, 1)
+
+    def _resize(self, capacity, dtype=None, shape=None):
+        if dtype is None:
+            dtype, shape = self._buffer.dtype, self._buffer.shape[1:]
+        buffer = np.empty((capacity, ) + shape, dtype)
+        if self._buffer is not None:
+            values = self._buffer[self._indices()]
+            if dtype == object:
+                for index, value in enumerate(values):
+                    buffer[index] = value
+            else:
+                buffer[:self._length] = values
+        self._buffer = buffer
+        self._start = 0
+
+    def _store(self, index, value):
+        buffer = self._buffer
+        numeric = self._numeric(value)
+        if buffer.dtype != object:
+            if numeric is None or numeric.shape != buffer.shape[1:]:
+                # values of varying types or shapes, fall back to objects
+                self._resize(len(buffer), object, ())
+            else:
+                dtype = np.result_type(buffer, numeric)
+                if dtype != buffer.dtype:
+                    self._resize(len(buffer), dtype, buffer.shape[1:])
+        if self._buffer.dtype == object and isinstance(value, np.ndarray):
+            value = value.copy()
+        self._buffer[(self._start + index) % len(self._buffer)] = value
+
+    def append(self, value):
+        capacity = self.capacity
+        if self._buffer is None:
+            numeric = self._numeric(value)
+            if numeric is None:
+                dtype, shape = object, ()
+            else:
+                dtype, shape = numeric.dtype, numeric.shape
+            self._resize(capacity or self.initial_capacity, dtype, shape)
+        elif self._length == len(self._buffer):
+            if capacity is None:
+                self._resize(2 * self._length)
+            else:
+                # full, discard the oldest value
+                self._accumulate(self._buffer[self._start], -1)
+                self._start = (self._start + 1) % capacity
+                self._length -= 1
+                self._evictions += 1
+        self._store(self._length, value)
+        self._length += 1
+        self._accumulate(value, 1)
+        if self._evictions >= len(self._buffer):
+            # amortized O(1), as it happens once every `capacity` evictions
+            self._evictions = 0
+            self._recompute()
+
+    def mean(self):
+        if self._mean is None:
+            return np.mean(np.array(self))
+        if not self._size:
+            return np.nan
+        return self._mean
+
+    def std(self):
+        if self._mean is None:
+            return np.std(np.array(self))
+        if not self._size:
+            return np.nan
+        # guards against rounding below zero when values are removed
+        return np.sqrt(max(self._deviations, 0.0) / self._size)
+
+
 class ResourceEstimator(object):
     default_history = 100
 
-    def __init__(self, batch_size, allow_reregister=True):
+    def __init__(self, batch_size, allow_reregister=True, format_interval=1):
         super().__init__()
         self.batch_size = batch_size
         self.allow_reregister = allow_reregister
+        self.format_interval = format_interval
+        self.step = 0
+        self._format_step = 0
         self.change = Change()
         self.operations = {}
         self.statistics = {}
@@ -30,7 +217,7 @@ class ResourceEstimator(object):
 
     def register(
             self, tensor, name, node=None, history=None,
-            transformer=None, formatter=None, debugger=None):
+            transformer=None, formatter=None, debugger=None, interval=None):
         """
         Register statistic tensors to be run by session.
 
@@ -45,6 +232,10 @@ class ResourceEstimator(object):
         transformer: transform value before adding to statistics.
         formatter: calls .register_print with `formatter`.
         debugger: function to print extra debug info.
+        interval:
+            run the tensor every `interval` steps; if interval='format', it is
+            run only on steps where statistics are printed; if not specified,
+            it is run on every step.
         """
         if not isinstance(tensor, (list, tuple, tf.Tensor, tf.Variable)):
             raise TypeError('We expect {!r} to be a Tensor.'.format(tensor))
@@ -57,7 +248,11 @@ class ResourceEstimator(object):
                 'Tensor named {!r} already registered for layer {!r}.'
                 .format(name, layer))
         layer[name] = tensor
-        prop[name] = {'history': history, 'transformer': transformer}
+        prop[name] = {
+            'history': history,
+            'transformer': transformer,
+            'interval': interval or 1,
+        }
         if formatter:
             self.register_formatter(formatter)
         if debugger:
@@ -79,29 +274,61 @@ class ResourceEstimator(object):
         if func not in self.debuggers:
             self.debuggers.append(func)
 
-    def add(self, value, name, node=None):
-        node = node or 'global'
-        try:
-            history = self.properties[node][name]['history']
-        except KeyError:
-            history = self.default_history
+    def _is_due(self, interval):
+        if interval == 'format':
+            interval = self.format_interval
+        return self.step % interval == 0
+
+    def format_due(self):
+        return self._is_due('format')
+
+    def operations_due(self):
+        """
+        The subset of `operations` to be run at the current step.
+        """
+        due = {}
+        for layer, tensors in self.operations.items():
+            prop = self.properties[layer]
+            for name, tensor in tensors.items():
+                if self._is_due(prop[name]['interval']):
+                    due.setdefault(layer, {})[name] = tensor
+        return due
+
+    def _history(self, node, name, history):
         stats = self.statistics.setdefault(node, {})
-        values = stats.setdefault(name, [])
-        if history != 'infinite' and history != 'running_mean':
-            while len(values) >= history:
-                values.pop(0)
+        values = stats.get(name)
+        if values is None:
+            if history == 'running_mean':
+                values = []
+            elif history == 'infinite':
+                values = History()
+            else:
+                values = History(history)
+            stats[name] = values
+        return values
+
+    def _add(self, value, name, node, history):
+        values = self._history(node, name, history)
         if history == 'running_mean':
             if len(values) >= 1:
                 # Wellford's Method, better numerical stability
                 mean, count = values[0]
-                mean += (value - mean) / float(count)
                 count += 1
+                mean += (value - mean) / float(count)
                 values[0] = (mean, count)
             else:
-                values.append((value, 0))
+                values.append((value, 1))
             return
         values.append(value)
 
+    def add(self, value, name, node=None):
+        node = node or 'global'
+        try:
+            history = self.properties[node][name]['history']
+        except KeyError:
+            history = self.default_history
+        self._add(value, name, node, history)
+
     def append(self, statistics):
         """
         Add new statistics to the estimator instance.
@@ -109,28 +336,13 @@ class ResourceEstimator(object):
         statistics: a [layer_node][statistic_name]-value nested mapping.
         """
         for layer, stats in statistics.items():
-            curr_stats = self.statistics.setdefault(layer, {})
             prop = self.properties[layer]
             for key, value in stats.items():
-                values = curr_stats.setdefault(key, [])
-                history = prop[key]['history']
-                if history != 'infinite' and history != 'running_mean':
-                    while len(values) >= history:
-                        values.pop(0)
                 transformer = prop[key]['transformer']
                 if transformer:
                     value = transformer(value)
-                if history == 'running_mean':
-                    if len(values) >= 1:
-                        # Wellford's Method, better numerical stability
-                        mean, count = values[0]
-                        mean += (value - mean) / float(count)
-                        count += 1
-                        values[0] = (mean, count)
-                    else:
-                        values.append((value, 1))
-                    continue
-                values.append(value)
+                self._add(value, key, layer, prop[key]['history'])
+        self.step += 1
 
     def max_len(self, name=None):
         l = 0
@@ -147,9 +359,11 @@ class ResourceEstimator(object):
             text.append(func(self))
         if batch_size:
             # performance
+            steps = self.step - self._format_step
+            self._format_step = self.step
             interval = self.change.delta('step.duration', time.time())
             if interval != 0:
-                imgs_per_sec = batch_size / float(interval)
+                imgs_per_sec = batch_size * steps / float(interval)
                 imgs_per_sec = self.change.moving_metrics(
                     'step.imgs_per_sec', imgs_per_sec, std=False)
                 text.append('tp: {:4.0f}/s'.format(imgs_per_sec))
@@ -195,10 +409,14 @@ class ResourceEstimator(object):
 
     def get_mean(self, name, node=None):
         history = self.get_history(name, node)
+        if isinstance(history, History):
+            return history.mean()
         return np.mean(history)
 
     def get_mean_std(self, name, node=None):
         history = self.get_history(name, node)
+        if isinstance(history, History):
+            return history.mean(), history.std()
         return np.mean(history), np.std(history)
 
     def get_tensor(self, name, node=None):
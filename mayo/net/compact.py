@@ -0,0 +1,411 @@
+import copy
+
+import numpy as np
+
+from mayo.log import log
+from mayo.util import ensure_list
+from mayo.net.graph import JoinNode
+
+
+class ChannelCompactor(object):
+    """
+    Physically removes pruned channels from a network.
+
+    `masks` maps convolution and fully connected layer nodes to boolean
+    masks of their output channels.  Masks are propagated through the
+    graph to find the channels to keep in each tensor:
+
+        channel-wise layers, e.g. batch normalization, activation,
+        pooling and depthwise convolution, keep the channels of their
+        inputs;
+        concat layers keep the channels of all inputs;
+        add layers couple the channels of their inputs, so layers producing
+        their inputs keep the union of their channels;
+        flatten layers keep the flattened positions of kept channels;
+        other layers, and the outputs of the network, keep all channels of
+        their inputs.
+
+    Pruned channels are masked before activation, so they may still carry
+    constant values to the layers consuming them, e.g. through a batch
+    normalization layer.  These constants are folded into the biases of
+    the consuming layers, or the moving means of their normalizers.
+    """
+    producers = ['convolution', 'fully_connected']
+    channelwise = [
+        'batch_normalization', 'activation', 'dropout', 'identity',
+        'max_pool', 'average_pool', 'pad']
+    # numpy equivalents of activation functions by their names in `tf.nn`
+    activations = {
+        None: lambda x: x,
+        'relu': lambda x: np.maximum(x, 0),
+        'relu6': lambda x: np.clip(x, 0, 6),
+        'elu': lambda x: np.where(x > 0, x, np.expm1(np.minimum(x, 0))),
+        'sigmoid': lambda x: 1 / (1 + np.exp(-x)),
+        'tanh': np.tanh,
+        'leaky_relu': lambda x: np.where(x > 0, x, 0.2 * x),
+    }
+    # the default epsilon of batch normalization
+    epsilon = 0.001
+
+    def __init__(self, net, masks):
+        super().__init__()
+        self.net = net
+        self.masks = masks
+        self.shapes = net.shapes(unified=True)
+        self._parents = {}
+        self._fixed = set()
+        # the channels kept in the input and the output of each layer,
+        # None keeps all channels
+        self.kept = {}
+        self._propagate_groups()
+        self._propagate_channels()
+
+    def _kind(self, node):
+        params = node.params
+        layer_type = params['type']
+        if layer_type == 'convolution':
+            return 'producer' if params.get('num_groups', 1) == 1 else None
+        if layer_type in self.producers:
+            return 'producer'
+        if layer_type == 'depthwise_convolution':
+            multiplier = params.get('depth_multiplier', 1)
+            return 'channelwise' if multiplier == 1 else None
+        if layer_type in ('squeeze', 'reduce_mean'):
+            axis = params.get('axis')
+            if axis is None or set(ensure_list(axis)) & {-1, 3}:
+                return None
+            return 'channelwise'
+        if layer_type == 'concat':
+            return 'concat' if params.get('axis') in (-1, 3) else None
+        if layer_type in self.channelwise:
+            return 'channelwise'
+        if layer_type in ('add', 'flatten'):
+            return layer_type
+        return None
+
+    def _group(self, key):
+        parent = self._parents.setdefault(key, key)
+        if parent == key:
+            return key
+        root = self._group(parent)
+        self._parents[key] = root
+        return root
+
+    def _union(self, key, other_key):
+        key, other_key = self._group(key), self._group(other_key)
+        if key != other_key:
+            self._parents[other_key] = key
+
+    @staticmethod
+    def _inputs(node, info):
+        # a list of information of each input
+        if isinstance(node.predecessors[0], JoinNode):
+            return info
+        return [info]
+
+    def _groups_input(self, node, groups):
+        self._fixed.add(node)
+        return [node]
+
+    def _groups_layer(self, node, groups):
+        # `groups` lists the layers producing the channels of the input
+        kind = self._kind(node)
+        if kind == 'producer':
+            return [node]
+        if kind in ('channelwise', 'flatten'):
+            return groups
+        inputs = self._inputs(node, groups)
+        if kind == 'concat':
+            return [g for each in inputs for g in each]
+        if kind == 'add':
+            first, *others = inputs
+            if any(len(each) != len(first) for each in others):
+                self._fixed.update(g for each in inputs for g in each)
+                return first
+            for each in others:
+                for group, other_group in zip(first, each):
+                    self._union(group, other_group)
+            return first
+        # unsupported layers use all channels of their inputs
+        self._fixed.update(g for each in inputs for g in each)
+        self._fixed.add(node)
+        return [node]
+
+    def _propagate_groups(self):
+        func_map = {'input': self._groups_input, 'layer': self._groups_layer}
+        groups = self.net.dataflow_analysis(func_map)
+        for node in self.net._graph.output_nodes():
+            self._fixed.update(groups[node])
+        fixed = {self._group(g) for g in self._fixed}
+        # a group keeps the union of channels kept by its layers
+        group_masks = {}
+        producers = []
+        for node in self.net._graph.layer_nodes():
+            if self._kind(node) != 'producer':
+                continue
+            producers.append(node)
+            num_channels = self.shapes[node][-1]
+            mask = self.masks.get(node)
+            if mask is None:
+                mask = np.ones(num_channels, dtype=bool)
+            elif mask.shape != (num_channels, ):
+                raise ValueError(
+                    'Mask of shape {} does not match the {} output channels '
+                    'of layer {!r}.'
+                    .format(mask.shape, num_channels, node.formatted_name()))
+            group = self._group(node)
+            if group in fixed:
+                mask = np.ones(num_channels, dtype=bool)
+            if group in group_masks:
+                mask = np.logical_or(group_masks[group], mask)
+            group_masks[group] = mask
+        self._producer_channels = {}
+        for node in producers:
+            mask = group_masks[self._group(node)]
+            if mask.all():
+                continue
+            kept = np.flatnonzero(mask)
+            if not kept.size:
+                log.warn(
+                    'All channels of layer {!r} are pruned, keeping one '
+                    'channel.'.format(node.formatted_name()))
+                kept = np.arange(1)
+            self._producer_channels[node] = kept
+
+    def _channels_layer(self, node, kept):
+        # `kept` is the indices of channels kept in the input
+        kind = self._kind(node)
+        if kind == 'concat':
+            inputs = self._inputs(node, kept)
+            if all(each is None for each in inputs):
+                return None
+            shapes = self._inputs(node, self.shapes[node.predecessors[0]])
+            offset = 0
+            channels = []
+            for each, shape in zip(inputs, shapes):
+                if each is None:
+                    each = np.arange(shape[-1])
+                channels.append(each + offset)
+                offset += shape[-1]
+            return np.concatenate(channels)
+        if kind == 'add':
+            # inputs keep identical channels as their groups are united
+            return self._inputs(node, kept)[0]
+        in_kept = kept
+        if kind == 'producer':
+            kept = self._producer_channels.get(node)
+        elif kind == 'flatten':
+            if kept is not None:
+                shape = self.shapes[node.predecessors[0]]
+                positions = np.arange(np.prod(shape[1:-1])) * shape[-1]
+                kept = (positions[:, None] + kept[None, :]).flatten()
+        elif kind != 'channelwise':
+            return None
+        self.kept[node] = (in_kept, kept)
+        return kept
+
+    def _propagate_channels(self):
+        func_map = {
+            'input': lambda node, info: None,
+            'layer': self._channels_layer,
+        }
+        self.net.dataflow_analysis(func_map)
+
+    def _activate(self, constants, name):
+        if name is not None:
+            name = name.rsplit('.', 1)[-1]
+        try:
+            func = self.activations[name]
+        except KeyError:
+            # unrecognized activations do not give known constants
+            return np.full_like(constants, np.nan)
+        return func(constants)
+
+    def _normalize(self, constants, values, prefix, params):
+        epsilon = params.get('epsilon')
+        if epsilon is None:
+            normalizer_params = params.get('normalizer_params') or {}
+            epsilon = normalizer_params.get('epsilon', self.epsilon)
+        nan = np.full_like(constants, np.nan)
+        mean = values.get(prefix + 'moving_mean', nan)
+        variance = values.get(prefix + 'moving_variance', nan)
+        gamma = values.get(prefix + 'gamma', 1)
+        beta = values.get(prefix + 'beta', 0)
+        deviation = np.sqrt(np.asarray(variance) + epsilon)
+        return gamma * (constants - mean) / deviation + beta
+
+    def _constants_input(self, node, constants):
+        return np.full(self.shapes[node][-1], np.nan)
+
+    def _constants_layer(self, node, constants, values):
+        # `constants` are the values of input channels, which are constant
+        # if they are pruned, or NaN if not constant
+        kind = self._kind(node)
+        params = node.params
+        prefix = '{}/'.format(node.formatted_name())
+        if kind == 'concat':
+            return np.concatenate(self._inputs(node, constants))
+        if kind == 'add':
+            return sum(self._inputs(node, constants))
+        if kind == 'producer':
+            # pruned channels are masked before activation
+            constants = np.zeros(self.shapes[node][-1])
+            return self._activate(
+                constants, params.get('activation_fn', 'relu'))
+        if kind == 'flatten':
+            shape = self.shapes[node.predecessors[0]]
+            return np.tile(constants, int(np.prod(shape[1:-1])))
+        if kind != 'channelwise':
+            return np.full(self.shapes[node][-1], np.nan)
+        layer_type = params['type']
+        if layer_type == 'batch_normalization':
+            constants = self._normalize(constants, values, prefix, params)
+            return self._activate(constants, params.get('activation_fn'))
+        if layer_type == 'activation':
+            return self._activate(constants, params['mode'])
+        if layer_type == 'identity':
+            return self._activate(constants, params.get('activation_fn'))
+        if layer_type in ('pad', 'depthwise_convolution'):
+            # only zeros remain constant with padding
+            constants = np.where(constants == 0, 0, np.nan)
+        if layer_type == 'depthwise_convolution':
+            if params.get('normalizer_fn'):
+                constants = self._normalize(
+                    constants, values, prefix + 'BatchNorm/', params)
+            else:
+                constants = constants + values.get(prefix + 'biases', 0)
+            return self._activate(
+                constants, params.get('activation_fn', 'relu'))
+        # dropout, pooling, squeeze and mean keep constants
+        return constants
+
+    def _propagate_constants(self, values):
+        func_map = {
+            'input': self._constants_input,
+            'layer': lambda node, constants:
+                self._constants_layer(node, constants, values),
+        }
+        return self.net.dataflow_analysis(func_map)
+
+    def _fold(self, node, constants, values, weights):
+        """
+        Folds the constant values of pruned input channels of `node`
+        multiplied with its `weights` into its biases, or the moving mean
+        of its normalizer.
+        """
+        name = node.formatted_name()
+        prefix = '{}/'.format(name)
+        in_kept, _ = self.kept[node]
+        in_channels, _ = self._num_channels(node)
+        pruned = np.setdiff1d(np.arange(in_channels), in_kept)
+        constants = constants[pruned]
+        if np.isnan(constants).any():
+            log.warn(
+                'Pruned input channels of layer {!r} are not constant, '
+                'removing them changes its outputs.'.format(name))
+            constants = np.nan_to_num(constants)
+        if not constants.any():
+            return
+        weights = np.take(weights, pruned, axis=-2)
+        kernel_size = weights.shape[:-2]
+        padding = node.params.get('padding', 'SAME').upper()
+        if np.prod(kernel_size) > 1 and padding == 'SAME':
+            log.warn(
+                'Pruned input channels of layer {!r} are folded into '
+                'biases, outputs at borders with padding differ.'
+                .format(name))
+        weights = weights.reshape(-1, len(pruned), weights.shape[-1])
+        shift = np.dot(constants, weights.sum(axis=0))
+        for key, sign in (('biases', 1), ('BatchNorm/moving_mean', -1)):
+            key = prefix + key
+            if key in values:
+                values[key] = np.asarray(values[key]) + sign * shift
+                return
+        log.warn(
+            'Layer {!r} has no biases to fold the constant values of its '
+            'pruned input channels into, removing them changes its '
+            'outputs.'.format(name))
+
+    def _num_channels(self, node):
+        in_shape = self.shapes[node.predecessors[0]]
+        return in_shape[-1], self.shapes[node][-1]
+
+    @staticmethod
+    def _take(value, kept, axis):
+        if kept is None:
+            return value
+        return np.take(value, kept, axis=axis)
+
+    def _compact_value(self, node, value):
+        in_kept, out_kept = self.kept[node]
+        in_channels, out_channels = self._num_channels(node)
+        kind = self._kind(node)
+        if kind == 'producer':
+            # weights, and variables of the same shape, e.g. masks
+            if value.shape[-2:] == (in_channels, out_channels):
+                value = self._take(value, in_kept, -2)
+        elif node.params['type'] == 'depthwise_convolution':
+            if value.ndim == 4:
+                return self._take(value, in_kept, -2)
+        if value.ndim and value.shape[-1] == out_channels:
+            value = self._take(value, out_kept, -1)
+        return value
+
+    def compact_values(self, values, weights=None):
+        """
+        Compacts a mapping from variable names to their values, and
+        returns the compacted mapping.  `weights` optionally maps layer
+        nodes to their overridden weights, which are used to fold constant
+        pruned channels instead of the weights in `values`.
+        """
+        values = dict(values)
+        weights = weights or {}
+        constants = self._propagate_constants(values)
+        for node, (in_kept, _) in self.kept.items():
+            if in_kept is None or self._kind(node) != 'producer':
+                continue
+            prefix = '{}/'.format(node.formatted_name())
+            node_weights = weights.get(node, values.get(prefix + 'weights'))
+            if node_weights is None:
+                continue
+            predecessor_constants = constants[node.predecessors[0]]
+            self._fold(
+                node, predecessor_constants, values,
+                np.asarray(node_weights))
+        prefixes = {}
+        for node, (in_kept, out_kept) in self.kept.items():
+            if in_kept is None and out_kept is None:
+                continue
+            prefixes['{}/'.format(node.formatted_name())] = node
+        compacted = {}
+        for name, value in values.items():
+            for prefix, node in prefixes.items():
+                if name.startswith(prefix):
+                    value = self._compact_value(node, np.asarray(value))
+                    break
+            compacted[name] = value
+        return compacted
+
+    def compact_model(self, model):
+        """
+        Returns a copy of the `model` definition, with the numbers of
+        output channels of layers reduced.
+        """
+        model = copy.deepcopy(model)
+        for node, kept in self._producer_channels.items():
+            # copy mappings on the path, which may be shared by aliases
+            params = model
+            for name in list(node.module[1:]) + [node.name]:
+                params['layers'] = dict(params['layers'])
+                params['layers'][name] = dict(params['layers'][name])
+                params = params['layers'][name]
+            log.debug(
+                'Reducing the number of outputs of layer {!r} to {}.'
+                .format(node.formatted_name(), len(kept)))
+            params['num_outputs'] = len(kept)
+        return model
+
+    def info(self):
+        return {
+            node.formatted_name(): (self.shapes[node][-1], len(kept))
+            for node, kept in self._producer_channels.items()}
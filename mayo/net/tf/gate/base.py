@@ -185,9 +185,13 @@ class GatedConvolutionBase(object):
             None, subsampled, params)
 
     def _register(self, name, tensor):
-        history = None if self.is_training else 'infinite'
+        if self.is_training:
+            history, interval = None, 'format'
+        else:
+            history, interval = 'infinite', None
         self.estimator.register(
-            tensor, 'gate.{}'.format(name), self.node, history=history)
+            tensor, 'gate.{}'.format(name), self.node,
+            history=history, interval=interval)
         return tensor
 
     @memoize_method
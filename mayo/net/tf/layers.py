@@ -1,7 +1,10 @@
+import collections
+
 import numpy as np
 import tensorflow as tf
 from tensorflow.contrib import slim
 
+from mayo.net.tf import sparse
 from mayo.net.tf.base import TFNetBase
 from mayo.net.tf.transform import use_name_not_scope
 from mayo.net.tf.estimate import LayerEstimateMixin
@@ -9,12 +12,93 @@ from mayo.net.tf.estimate import LayerEstimateMixin
 
 class Layers(TFNetBase, LayerEstimateMixin):
     """ Create a TensorFlow graph from "config.model" model definition.  """
+    def __init__(self, *args, **kwargs):
+        # layers which can run with sparse weights, their inputs, and
+        # their `sparse.SparseWeights` if sparse execution is enabled
+        self.sparse_layers = collections.OrderedDict()
+        super().__init__(*args, **kwargs)
+
+    @property
+    def _sparse_max_density(self):
+        """
+        The maximum density of weights for convolution and fully connected
+        layers to run with sparse weights during inference, or None if
+        sparse execution is disabled.
+        """
+        if self.is_training:
+            return None
+        system = self.session.config.system
+        if not system.get('sparse.enable', False):
+            return None
+        return system.get('sparse.max_density', 0.3)
+
+    def _instantiate_sparse(
+            self, node, tensor, params, weights_shape, func,
+            force_biases=False):
+        scope = params['scope']
+        weights_initializer = params.get(
+            'weights_initializer', tf.contrib.layers.xavier_initializer())
+        weights = tf.get_variable(
+            '{}/weights'.format(scope), weights_shape,
+            initializer=weights_initializer,
+            regularizer=params.get('weights_regularizer'))
+        # the form of weights is fixed after checkpoints are loaded
+        with tf.name_scope('{}/sparse'.format(scope)):
+            weights = sparse.SparseWeights(
+                weights, self._sparse_max_density)
+        self.sparse_layers[node]['weights'] = weights
+        output = func(tensor, weights)
+        # biases are absent with normalization, as in slim layers
+        normalizer_fn = params.get('normalizer_fn')
+        biases_initializer = params.get(
+            'biases_initializer', tf.zeros_initializer())
+        if biases_initializer and (force_biases or not normalizer_fn):
+            biases = tf.get_variable(
+                '{}/biases'.format(scope), weights_shape[-1],
+                initializer=biases_initializer,
+                regularizer=params.get('biases_regularizer'))
+            output = tf.nn.bias_add(output, biases)
+        if normalizer_fn:
+            normalizer_params = dict(
+                params.get('normalizer_params') or {},
+                scope='{}/BatchNorm'.format(scope))
+            output = normalizer_fn(output, **normalizer_params)
+        activation_fn = params.get('activation_fn', tf.nn.relu)
+        if activation_fn:
+            output = activation_fn(output)
+        return output
+
+    def _sparse_convolution(self, node, tensor, params, force_biases):
+        if params.get('rate', 1) not in (1, [1, 1]):
+            return None
+        kernel = params['kernel_size']
+        if isinstance(kernel, int):
+            kernel = [kernel, kernel]
+        stride = params.get('stride', 1)
+        if isinstance(stride, int):
+            stride = [stride, stride]
+        stride = list(stride)
+        padding = params.get('padding', 'SAME')
+        self.sparse_layers[node] = {
+            'inputs': tensor, 'stride': stride, 'padding': padding}
+        if self._sparse_max_density is None:
+            return None
+        weights_shape = list(kernel) + [
+            int(tensor.shape[-1]), params['num_outputs']]
+        func = lambda x, w: w.conv2d(x, stride, padding)
+        return self._instantiate_sparse(
+            node, tensor, params, weights_shape, func, force_biases)
+
     def instantiate_convolution(self, node, tensor, params):
         scope = params.get('scope')
         norm_scope = scope + '/BatchNorm'
         groups = params.pop('num_groups', 1)
         if groups == 1:
             force_biases = params.pop('force_biases', False)
+            output = self._sparse_convolution(
+                node, tensor, params, force_biases)
+            if output is not None:
+                return output
             if not force_biases:
                 return slim.conv2d(tensor, **params)
             normalizer_fn = params.pop('normalizer_fn', None)
@@ -137,7 +221,15 @@ class Layers(TFNetBase, LayerEstimateMixin):
         return slim.max_pool2d(tensor, **params)
 
     def instantiate_fully_connected(self, node, tensor, params):
-        return slim.fully_connected(tensor, **params)
+        if len(tensor.shape) != 2:
+            return slim.fully_connected(tensor, **params)
+        self.sparse_layers[node] = {'inputs': tensor}
+        if self._sparse_max_density is None:
+            return slim.fully_connected(tensor, **params)
+        weights_shape = [int(tensor.shape[-1]), params['num_outputs']]
+        func = lambda x, w: w.matmul(x)
+        return self._instantiate_sparse(
+            node, tensor, params, weights_shape, func)
 
     def instantiate_softmax(self, node, tensor, params):
         return slim.softmax(tensor, **params)
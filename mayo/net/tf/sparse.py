@@ -0,0 +1,226 @@
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from mayo.log import log
+from mayo.util import Percent, Table
+
+
+def sparse_matmul(inputs, weights):
+    """
+    Multiplies [M, K] `inputs` with [K, N] weights, where `weights` is
+    their [N, K] transpose as a sparse tensor of the nonzero weights.
+    """
+    outputs = tf.sparse_tensor_dense_matmul(weights, inputs, adjoint_b=True)
+    return tf.transpose(outputs)
+
+
+def sparse_conv2d(inputs, weights, kernel_size, stride, padding):
+    """
+    Convolves NHWC `inputs` with sparse `weights` of `sparse_matmul()` by
+    multiplying the im2col patches of `inputs` with the nonzero weights.
+    """
+    kernel_h, kernel_w = kernel_size
+    patches = tf.extract_image_patches(
+        inputs, [1, kernel_h, kernel_w, 1], [1] + stride + [1],
+        [1, 1, 1, 1], padding)
+    # patches are ordered as (kernel_h, kernel_w, channels), which matches
+    # the layout of the weights
+    patch_size = int(patches.shape[-1])
+    outputs = sparse_matmul(tf.reshape(patches, [-1, patch_size]), weights)
+    outputs = tf.reshape(
+        outputs, tf.concat([tf.shape(patches)[:3], [-1]], axis=0))
+    num_outputs = tf.contrib.util.constant_value(weights.dense_shape)[0]
+    outputs.set_shape(patches.shape[:3].concatenate([num_outputs]))
+    return outputs
+
+
+def sparse_matrix(weights):
+    """
+    The nonzero entries of numpy `weights`, flattened to a [K, N] matrix,
+    as the indices and values of its [N, K] transpose in row-major order.
+    """
+    matrix = weights.reshape(-1, weights.shape[-1]).T
+    indices = np.argwhere(matrix)
+    return indices, matrix[tuple(indices.T)]
+
+
+class SparseWeights(object):
+    """
+    The weights of a layer fixed from their values after checkpoints are
+    loaded, and held either densely or as a sparse matrix of their nonzero
+    entries, whichever is chosen from their density.  Both forms are kept
+    in non-trainable variables, so that the sparse matrix is not rebuilt
+    at each step.
+    """
+    def __init__(self, weights, max_density):
+        super().__init__()
+        # the overridden weights to fix
+        self.weights = weights
+        self.max_density = max_density
+        self.shape = weights.shape.as_list()
+        num_outputs = self.shape[-1]
+        self.matrix_shape = [num_outputs, int(np.prod(self.shape[:-1]))]
+        dtype = weights.dtype.base_dtype
+        self.is_sparse = tf.Variable(
+            False, trainable=False, collections=[], name='is_sparse')
+        # the form not chosen is emptied
+        self.dense = self._variable('dense', dtype, [0])
+        self.indices = self._variable('indices', tf.int64, [0, 2])
+        self.values = self._variable('values', dtype, [0])
+        self._placeholders = []
+        assignments = []
+        for var in (self.is_sparse, self.dense, self.indices, self.values):
+            placeholder = tf.placeholder(var.dtype.base_dtype)
+            self._placeholders.append(placeholder)
+            assignments.append(
+                tf.assign(var, placeholder, validate_shape=False))
+        self._assign_op = tf.group(*assignments)
+
+    @staticmethod
+    def _variable(name, dtype, shape):
+        # shapes vary with the form chosen, and variables are not in
+        # collections as they are not saved to or loaded from checkpoints
+        return tf.Variable(
+            tf.zeros(shape, dtype), trainable=False, validate_shape=False,
+            collections=[], name=name)
+
+    def _sparse(self):
+        shape = np.array(self.matrix_shape, np.int64)
+        return tf.SparseTensor(self.indices, self.values, shape)
+
+    def _dense(self):
+        return tf.reshape(self.dense, self.shape)
+
+    def matmul(self, inputs):
+        outputs = tf.cond(
+            self.is_sparse,
+            lambda: sparse_matmul(inputs, self._sparse()),
+            lambda: tf.matmul(inputs, self._dense()))
+        outputs.set_shape(inputs.shape[:1].concatenate(self.shape[-1:]))
+        return outputs
+
+    def conv2d(self, inputs, stride, padding):
+        return tf.cond(
+            self.is_sparse,
+            lambda: sparse_conv2d(
+                inputs, self._sparse(), self.shape[:2], stride, padding),
+            lambda: tf.nn.conv2d(
+                inputs, self._dense(), [1] + stride + [1], padding))
+
+    def feed(self, value):
+        """
+        Chooses the form of the weights from their numpy `value`, and
+        returns the assignment op with the feed to fix them.
+        """
+        density = np.count_nonzero(value) / value.size
+        is_sparse = density <= self.max_density
+        log.debug(
+            'Weights {!r} with density {} run {}.'.format(
+                self.weights.op.name, Percent(density),
+                'sparse' if is_sparse else 'dense'))
+        empty = np.zeros(0, dtype=value.dtype)
+        if is_sparse:
+            indices, values = sparse_matrix(value)
+            dense = empty
+        else:
+            indices = np.zeros([0, 2], dtype=np.int64)
+            values = empty
+            dense = value.flatten()
+        forms = (is_sparse, dense, indices, values)
+        return self._assign_op, dict(zip(self._placeholders, forms))
+
+
+def assign_sparse_weights(session, sparse_weights):
+    """
+    Fixes `sparse_weights` from the current values of their weights
+    in `session`.
+    """
+    if not sparse_weights:
+        return
+    values = session.run([w.weights for w in sparse_weights])
+    ops = []
+    feed_dict = {}
+    for weights, value in zip(sparse_weights, values):
+        op, feed = weights.feed(value)
+        ops.append(op)
+        feed_dict.update(feed)
+    session.raw_run(ops, feed_dict=feed_dict)
+
+
+def _measure(build, inputs, num_runs, warmup):
+    """
+    Measures the average latency in milliseconds of the op produced by
+    `build(inputs)` on the CPU.
+    """
+    graph = tf.Graph()
+    with graph.as_default(), tf.device('/cpu:0'):
+        placeholder = tf.placeholder(tf.float32, inputs.shape)
+        op = build(placeholder)
+        init = tf.global_variables_initializer()
+    config = tf.ConfigProto(device_count={'GPU': 0})
+    with tf.Session(graph=graph, config=config) as session:
+        session.run(init)
+        feed_dict = {placeholder: inputs}
+        for _ in range(warmup):
+            session.run(op, feed_dict=feed_dict)
+        wall = time.time()
+        for _ in range(num_runs):
+            session.run(op, feed_dict=feed_dict)
+        wall = time.time() - wall
+    return 1000.0 * wall / num_runs
+
+
+def bench_sparse(session, batch_size=1, num_runs=20, warmup=5):
+    """
+    Benchmarks the CPU latency of dense and sparse execution of the
+    convolution and fully connected layers of the network in `session`
+    with their overridden weights, against the MACs of the estimator.
+    """
+    net = session.task.nets[0]
+    stats = net.estimate()
+    headers = [
+        'layer', 'density', 'macs', 'dense (ms)', 'sparse (ms)',
+        'speedup', 'ideal']
+    formatters = {h: None for h in headers}
+    for h in ('dense (ms)', 'sparse (ms)'):
+        formatters[h] = lambda v, w: '{:{w}.3f}'.format(v, w=w or 0)
+    for h in ('speedup', 'ideal'):
+        formatters[h] = lambda v, w: '{:{w}.2f}x'.format(v, w=max(w - 1, 0))
+    table = Table(headers, formatters)
+    for node, layer in net.sparse_layers.items():
+        name = node.formatted_name()
+        log.info('Measuring layer {!r}...'.format(name), update=True)
+        weights = session.run(net.variables[node]['weights'])
+        shape = [batch_size] + layer['inputs'].shape.as_list()[1:]
+        inputs = np.random.normal(size=shape).astype(np.float32)
+        indices, values = sparse_matrix(weights)
+        num_outputs = weights.shape[-1]
+        matrix_shape = np.array(
+            [num_outputs, weights.size // num_outputs], np.int64)
+        # weights are variables so that they are not folded
+        dense_weights = lambda: tf.Variable(weights)
+        sparse_weights = lambda: tf.SparseTensor(
+            tf.Variable(indices), tf.Variable(values), matrix_shape)
+        stride = layer.get('stride')
+        if stride is None:
+            dense = lambda x: tf.matmul(x, dense_weights())
+            sparse = lambda x: sparse_matmul(x, sparse_weights())
+        else:
+            padding = layer['padding']
+            dense = lambda x: tf.nn.conv2d(
+                x, dense_weights(), [1] + stride + [1], padding)
+            sparse = lambda x: sparse_conv2d(
+                x, sparse_weights(), weights.shape[:2], stride, padding)
+        dense_time = _measure(dense, inputs, num_runs, warmup)
+        sparse_time = _measure(sparse, inputs, num_runs, warmup)
+        layer_density = np.count_nonzero(weights) / weights.size
+        ideal = 1 / layer_density if layer_density else float('inf')
+        table.add_row((
+            name, Percent(layer_density), stats[node].get('macs'),
+            dense_time, sparse_time, dense_time / sparse_time, ideal))
+    table.footer_sum('macs')
+    table.footer_sum('dense (ms)')
+    table.footer_sum('sparse (ms)')
+    return table
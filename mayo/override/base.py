@@ -61,13 +61,15 @@ class Parameter(object):
                         .format(self.name, key))
             kwargs[key] = value
         kwargs['name'] = self.name
+        # the configuration may override the dtype, e.g. for packed masks
+        dtype = defaults.get('dtype', self.dtype)
         init = kwargs.pop('initial')
         from tensorflow.python.ops.init_ops import Initializer
         if init is not None and not isinstance(init, Initializer):
             init = tf.constant_initializer(
-                value=init, dtype=self.dtype, verify_shape=True)
+                value=init, dtype=dtype, verify_shape=True)
         kwargs['initializer'] = init
-        kwargs['dtype'] = self.dtype
+        kwargs['dtype'] = dtype
         kwargs['trainable'] = self.trainable
         return kwargs
 
@@ -88,6 +90,7 @@ class Parameter(object):
 
     def __set__(self, instance, value):
         instance._parameter_variables_assignment[self.name] = value
+        instance.session.mark_overrider_dirty(instance)
 
 
 class OverriderBase(object):
@@ -98,9 +101,13 @@ class OverriderBase(object):
 
     The method `_apply` overrides the variable in `value`, returns the
     overridden result; `_update` updates states of tensorflow variables used in
-    `_apply`.
+    `_apply`.  Alternatively, `_update_op` can build an operation which
+    updates the states in the graph, these operations are grouped and run
+    on device by the session.
     """
     enable = Parameter('enable', True, [], 'bool')
+    # graph collection of all variables instantiated by overriders
+    variables_collection = 'mayo/overrider_variables'
 
     def __init__(self, session, should_update=True, enable=True):
         super().__init__()
@@ -113,6 +120,7 @@ class OverriderBase(object):
         self._parameter_variables = {}
         self._parameter_variables_assignment = {}
         self._getter = _getter_not_initialized
+        self.update_op = None
         self.should_update = should_update
         self.enable = enable
 
@@ -171,6 +179,8 @@ class OverriderBase(object):
             var_name = '{}/{}.{}'.format(scope, self.__class__.__name__, name)
             var = getter(var_name, *args, **kwargs)
             self.internals[name] = var
+            if var not in tf.get_collection(self.variables_collection):
+                tf.add_to_collection(self.variables_collection, var)
             return var
         wrapped.__qualname__ = '{}.wrapped.{}'.format(
             self._tracking_getter.__qualname__, getter)
@@ -199,6 +209,7 @@ class OverriderBase(object):
         # ensure instantiation of all parameter variables
         for param in self.parameters.values():
             param.__get__(self, None)
+        self.update_op = self._update_op()
         return self.after
 
     def _update(self):
@@ -208,6 +219,14 @@ class OverriderBase(object):
         """
         pass
 
+    def _update_op(self):
+        """
+        Override this method called in `.apply()` to return an operation
+        which updates internal states of the overrider in the graph, it is
+        used by `.update()` in place of `._update()`.
+        """
+        return None
+
     def update(self):
         """Update things to apply during training.  """
         if not self.should_update:
@@ -215,6 +234,10 @@ class OverriderBase(object):
         if not self._applied:
             raise OverrideNotAppliedError(
                 'Method "apply" must be invoked before call "update".')
+        if self.update_op is not None:
+            # run later with other update operations in a single group
+            self.session.mark_overrider_update(self)
+            return
         name = '{}.update()'.format(self.__class__.__name__)
         with self.session.ensure_graph_unchanged(name):
             self._update()
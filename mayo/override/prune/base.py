@@ -5,34 +5,77 @@ from mayo.override import util
 from mayo.override.base import OverriderBase, Parameter
 
 
-class PrunerBase(OverriderBase):
+class MaskPrunerBase(OverriderBase):
+    """
+    Base class of pruners which multiply values with a boolean mask.
+
+    packed:
+        if true, the mask is stored as bit-packed uint8 words and unpacked
+        on device, which reduces its size in checkpoints and the transfers
+        of `.info()` by 8x.
+    """
     mask = Parameter('mask', None, None, 'bool')
 
-    def __init__(self, session, should_update=True):
+    def __init__(self, session, should_update=True, packed=False):
         super().__init__(session, should_update)
+        self.packed = packed
 
-    def _apply(self, value):
-        self._parameter_config = {
-            'mask': {
+    def _mask_config(self, shape):
+        self.mask_shape = tf.TensorShape(shape)
+        if not self.packed:
+            return {
                 'initial': tf.ones_initializer(dtype=tf.bool),
-                'shape': value.shape,
+                'shape': self.mask_shape,
             }
+        num_words = util.ceil(self.mask_shape.num_elements() / 8)
+        return {
+            # padded bits are ignored when unpacked
+            'initial': tf.constant_initializer(255, dtype=tf.uint8),
+            'shape': [num_words],
+            'dtype': tf.uint8,
         }
-        return value * util.cast(self.mask, float)
+
+    def _masked(self, value, shape):
+        """
+        Masks `value` with a mask of `shape` which broadcasts to `value`.
+        """
+        self._parameter_config = {'mask': self._mask_config(shape)}
+        if self.packed:
+            self.dense_mask = util.unpack_bits(
+                self.mask, self.mask_shape.as_list())
+        else:
+            self.dense_mask = self.mask
+        return value * util.cast(self.dense_mask, float)
 
     def _updated_mask(self, var, mask):
         raise NotImplementedError(
             'Method to compute an updated mask is not implemented.')
 
+    def _packed_mask(self, mask):
+        if self.packed:
+            return util.pack_bits(mask)
+        return mask
+
     def _update(self):
-        mask = self._updated_mask(self.before, self.mask)
-        self.session.assign(self.mask, mask)
+        mask = self._updated_mask(self.before, self.dense_mask)
+        self.session.assign(self.mask, self._packed_mask(mask))
 
     def _info(self):
-        mask = util.cast(self.session.run(self.mask), int)
-        density = Percent(util.sum(mask) / util.count(mask))
+        mask = self.session.run(self.mask)
+        if self.packed:
+            count = self.mask_shape.num_elements()
+            active = util.count_bits(mask, count)
+        else:
+            count = mask.size
+            active = util.sum(util.cast(mask, int))
+        density = Percent(active / count)
         return self._info_tuple(
-            mask=self.mask.name, density=density, count_=mask.size)
+            mask=self.mask.name, density=density, count_=count)
+
+
+class PrunerBase(MaskPrunerBase):
+    def _apply(self, value):
+        return self._masked(value, value.shape)
 
     @classmethod
     def finalize_info(cls, table):
@@ -44,12 +87,7 @@ class PrunerBase(OverriderBase):
         return footer
 
 
-class ChannelPrunerBase(OverriderBase):
-    mask = Parameter('mask', None, None, 'bool')
-
-    def __init__(self, session, should_update=True):
-        super().__init__(session, should_update)
-
+class ChannelPrunerBase(MaskPrunerBase):
     def _apply(self, value):
         # check shape
         if not len(value.shape) >= 3:
@@ -57,28 +95,8 @@ class ChannelPrunerBase(OverriderBase):
                 'Incorrect dimension {} for channel pruner'
                 .format(value.shape))
         self.num_channels = value.shape[-1]
-        self._parameter_config = {
-            'mask': {
-                'initial': tf.ones_initializer(dtype=tf.bool),
-                'shape': self.num_channels,
-            },
-        }
-        mask = tf.reshape(self.mask, (1, 1, 1, -1))
-        return value * util.cast(mask, float)
-
-    def _updated_mask(self, var, mask):
-        raise NotImplementedError(
-            'Method to compute an updated mask is not implemented.')
-
-    def _update(self):
-        mask = self._updated_mask(self.before, self.mask)
-        self.session.assign(self.mask, mask)
-
-    def _info(self):
-        mask = util.cast(self.session.run(self.mask), int)
-        density = Percent(util.sum(mask) / util.count(mask))
-        return self._info_tuple(
-            mask=self.mask.name, density=density, count_=mask.size)
+        # the mask broadcasts along the last dimension
+        return self._masked(value, [self.num_channels])
 
     @classmethod
     def finalize_info(cls, table):
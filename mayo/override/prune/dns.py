@@ -1,3 +1,5 @@
+import tensorflow as tf
+
 from mayo.override import util
 from mayo.override.base import Parameter
 from mayo.override.prune.base import PrunerBase
@@ -6,8 +8,9 @@ from mayo.override.prune.base import PrunerBase
 class MeanStdPruner(PrunerBase):
     alpha = Parameter('alpha', -2, [], 'float')
 
-    def __init__(self, session, alpha=None, should_update=True):
-        super().__init__(session, should_update)
+    def __init__(
+            self, session, alpha=None, should_update=True, packed=False):
+        super().__init__(session, should_update, packed)
         self.alpha = alpha
 
     def _threshold(self, tensor, alpha=None):
@@ -22,6 +25,12 @@ class MeanStdPruner(PrunerBase):
     def _updated_mask(self, var, mask):
         return util.abs(var) > self._threshold(var)
 
+    def _update_op(self):
+        # the threshold and mask are computed on device, avoiding the
+        # transfer of weights to host
+        mask = self._updated_mask(self.before, self.dense_mask)
+        return tf.assign(self.mask, self._packed_mask(mask))
+
     def _info(self):
         _, mask, density, count = super()._info()
         alpha = self.session.run(self.alpha)
@@ -37,14 +46,13 @@ class DynamicNetworkSurgeryPruner(MeanStdPruner):
     """
     def __init__(
             self, session, alpha=None, on_factor=1.1, off_factor=0.9,
-            should_update=True):
-        super().__init__(session, alpha, should_update)
+            should_update=True, packed=False):
+        super().__init__(session, alpha, should_update, packed)
         self.on_factor = on_factor
         self.off_factor = off_factor
 
     def _updated_mask(self, var, mask):
-        var, mask, alpha = self.session.run([var, mask, self.alpha])
-        threshold = self._threshold(var, alpha)
+        threshold = self._threshold(var)
         on_mask = util.abs(var) > self.on_factor * threshold
         mask = util.logical_or(mask, on_mask)
         off_mask = util.abs(var) > self.off_factor * threshold
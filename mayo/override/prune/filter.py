@@ -1,5 +1,3 @@
-import tensorflow as tf
-
 from mayo.override import util
 from mayo.override.base import Parameter
 from mayo.override.prune.base import PrunerBase
@@ -7,20 +5,14 @@ from mayo.override.prune.base import PrunerBase
 
 class FilterPruner(PrunerBase):
     density = Parameter('density', 0.0, [], 'float')
-    mask = Parameter('mask', None, None, 'bool')
 
-    def __init__(self, session, density=None, should_update=True):
-        super().__init__(session, should_update)
+    def __init__(
+            self, session, density=None, should_update=True, packed=False):
+        super().__init__(session, should_update, packed)
         self.density = density
 
     def _apply(self, value):
-        self._parameter_config = {
-            'mask': {
-                'initial': tf.ones_initializer(dtype=tf.bool),
-                'shape': tf.TensorShape([value.shape[-2], value.shape[-1]]),
-            }
-        }
-        return value * util.cast(self.mask, float)
+        return self._masked(value, [value.shape[-2], value.shape[-1]])
 
     def _l1_norm(self, value):
         # compute l1 norm for each filter
@@ -33,9 +25,8 @@ class FilterPruner(PrunerBase):
         return util.sum(util.abs(value), axis=(0, 1))
 
     def _threshold(self, value, density):
-        value = value.flatten()
         index = int(value.size * density)
-        return sorted(value)[index]
+        return util.kth_smallest(value, index)
 
     def _updated_mask(self, tensor, mask):
         value, mask, density = self.session.run([tensor, mask, self.density])
@@ -23,8 +23,9 @@ class NetworkSlimmer(ChannelPrunerBase):
     """
     def __init__(
             self, session, density, weight=0.01,
-            global_threshold=True, incremental=False, should_update=True):
-        super().__init__(session, should_update)
+            global_threshold=True, incremental=False, should_update=True,
+            packed=False):
+        super().__init__(session, should_update, packed)
         self.density = density
         self.weight = weight
         self.global_threshold = global_threshold
@@ -44,10 +45,8 @@ class NetworkSlimmer(ChannelPrunerBase):
     def _apply(self, value):
         masked = super()._apply(value)
         gamma = self.gamma
-        # register the latest gamma and mask to be used for later update
-        # TODO this works as a way to collect global gammas, but the `gamma`
-        # tensor is evaluated every time we use `session.run(batch=True)`,
-        # will fix later if performance proves to be problematic.
+        # register the latest gamma and mask to be used for later update,
+        # gamma is sampled on every step so that it is never stale
         self.session.estimator.register(
             gamma, 'NetworkSlimmer.gamma', node=self, history=1)
         # add reg
@@ -57,12 +56,14 @@ class NetworkSlimmer(ChannelPrunerBase):
         return util.cast(masked, float)
 
     def _threshold(self, values):
-        if not values:
+        # `values` is a list of gamma arrays, selected across globally
+        num_values = sum(v.size for v in values)
+        if not num_values:
             return 0
-        num_active = util.ceil(len(values) * self.density)
-        if num_active == len(values):
+        num_active = util.ceil(num_values * self.density)
+        if num_active == num_values:
             return 0
-        return sorted(values)[-num_active - 1]
+        return util.kth_smallest(values, -num_active - 1)
 
     def _global_threshold(self):
         estimator = self.session.estimator
@@ -81,9 +82,9 @@ class NetworkSlimmer(ChannelPrunerBase):
             if not overrider.should_update:
                 continue
             if self.incremental:
-                mask = self.session.run(overrider.mask)
+                mask = self.session.run(overrider.dense_mask)
                 gamma = gamma[util.nonzero(mask)]
-            gammas += gamma.tolist()
+            gammas.append(gamma)
         threshold = self._threshold(gammas)
         log.debug(
             'Extracted a global threshold for all gammas: {}.'
@@ -97,16 +98,17 @@ class NetworkSlimmer(ChannelPrunerBase):
         if self.global_threshold:
             threshold = self._global_threshold()
         else:
+            gammas = gamma
             if self.incremental:
-                gammas = gamma[util.nonzero(self.mask)]
-            threshold = self._threshold(gammas)
+                gammas = gamma[util.nonzero(mask)]
+            threshold = self._threshold([gammas])
         new_mask = gamma > threshold
         if self.incremental:
             return util.logical_and(mask, new_mask)
         return new_mask
 
     def estimate(self, layer_info, info):
-        mask = [self.session.run(self.mask)]
+        mask = [self.session.run(self.dense_mask)]
         macs = layer_info.get('macs', 0)
         weights = layer_info.get('weights', 0)
         density, active = self.session.estimator._mask_density(mask)
@@ -94,7 +94,7 @@ class MixedQuantizer(QuantizerBase):
         loss_vec = util.mean(loss * unquantized_mask, (0, 1, 2))
         # sort
         num_active = util.ceil(len(loss_vec) * interval)
-        threshold = sorted(loss_vec)[num_active]
+        threshold = util.kth_smallest(loss_vec, num_active)
         if interval >= 1.0:
             return util.cast(unquantized_mask, float)
         new_mask = (unquantized_mask * loss) > threshold
@@ -203,12 +203,37 @@ def clip_by_value(tensor, minimum, maximum, transparent_backprop=False):
         return tf.clip_by_value(tensor, minimum, maximum)
 
 
+def kth_smallest(values, k):
+    """
+    The `k`-th smallest value in `values`, equivalent to
+    `sorted(values)[k]` but without sorting, `k` can be negative.  `values`
+    can be an array, a tensor, or a list of them, in which case the value
+    is selected globally across all of them.
+    """
+    if isinstance(values, (list, tuple)):
+        if is_tensor(*values):
+            values = tf.concat([tf.reshape(v, [-1]) for v in values], 0)
+        else:
+            values = np.concatenate([np.ravel(v) for v in values])
+    if is_tensor(values):
+        values = tf.reshape(values, [-1])
+        if k < 0:
+            k += tf.size(values)
+        # the k-th smallest value is the smallest of the k + 1 largest
+        # negated values
+        return -tf.nn.top_k(-values, k + 1).values[-1]
+    values = np.ravel(values)
+    if k < 0:
+        k += values.size
+    return np.partition(values, k)[k]
+
+
 def top_k(tensor, k):
     if is_tensor(tensor):
         tensor = tf.reshape(tensor, [-1])
         topk = tf.nn.top_k(tensor, k)
         return tf.reduce_min(cast(topk.values, float))
-    return sorted(tensor)[k]
+    return kth_smallest(tensor, k)
 
 
 def moments(tensor, axes):
@@ -239,3 +264,54 @@ def stochastic_round(tensor, stochastic):
     mod = tf if is_tensor(tensor) else np
     randoms = mod.random_uniform(shape=tensor.shape)
     return where(randoms > prob, value_floor, value_ceil)
+
+
+# weights of bits in a packed uint8 word, most significant bit first as in
+# `np.packbits`
+_bit_weights = np.array([128, 64, 32, 16, 8, 4, 2, 1], dtype=np.uint8)
+_popcount_table = np.array([bin(i).count('1') for i in range(256)])
+
+
+def pack_bits(value):
+    """
+    Packs a boolean array into a flat array of uint8 words, the last word is
+    padded with zero bits.
+    """
+    if is_constant(value):
+        _constants_not_accepted(pack_bits)
+    if is_numpy(value):
+        return np.packbits(value.flatten())
+    value = tf.reshape(tf.cast(value, tf.int32), [-1])
+    value = tf.pad(value, [[0, -tf.size(value) % 8]])
+    value = tf.reshape(value, [-1, 8]) * _bit_weights.astype(np.int32)
+    return tf.cast(tf.reduce_sum(value, axis=-1), tf.uint8)
+
+
+def unpack_bits(value, shape):
+    """
+    Unpacks uint8 words into a boolean array of `shape`, discarding padded
+    bits.
+    """
+    if is_constant(value):
+        _constants_not_accepted(unpack_bits)
+    num_bits = int(np.prod(shape))
+    if is_numpy(value):
+        bits = np.unpackbits(value)[:num_bits]
+        return bits.reshape(shape).astype(np.bool)
+    bits = tf.bitwise.bitwise_and(
+        tf.expand_dims(value, -1), tf.constant(_bit_weights))
+    bits = tf.reshape(tf.not_equal(bits, 0), [-1])[:num_bits]
+    return tf.reshape(bits, shape)
+
+
+def count_bits(value, num_bits):
+    """
+    Population count of the first `num_bits` bits in uint8 words.
+    """
+    if not is_numpy(value):
+        raise TypeError('count_bits() only accepts numpy arrays.')
+    num_words, remainder = divmod(num_bits, 8)
+    count = np.sum(_popcount_table[value[:num_words]])
+    if remainder:
+        count += np.sum(np.unpackbits(value[num_words:])[:remainder])
+    return int(count)
@@ -1,3 +1,4 @@
+import random
 import functools
 from contextlib import contextmanager
 
@@ -9,8 +10,12 @@ from mayo.util import (
     memoize_property, flatten, object_from_params,
     Change, Table, Percent, print_variables)
 from mayo.estimate import ResourceEstimator
-from mayo.override import ChainOverrider
+from mayo.override import ChainOverrider, util
+from mayo.override.prune.base import MaskPrunerBase, ChannelPrunerBase
+from mayo.net.compact import ChannelCompactor
+from mayo.net.tf.sparse import assign_sparse_weights
 from mayo.session.checkpoint import CheckpointHandler
+from mayo.session.trace import StepTracer
 
 
 class ReadOnlyGraphChangedError(Exception):
@@ -57,6 +62,8 @@ class SessionMeta(type):
 
 class SessionBase(object, metaclass=SessionMeta):
     mode = None
+    # input iterators to be initialized before they are used
+    iterators_collection = 'mayo.session.iterators'
 
     def __init__(self, config):
         super().__init__()
@@ -72,15 +79,25 @@ class SessionBase(object, metaclass=SessionMeta):
         self.change = Change()
         self.tf_graph = tf.Graph()
         self.initialized_variables = []
+        self.initialized_iterators = []
+        self._num_checked_variables = 0
         self._assign_operators = {}
+        self._assign_groups = {}
         self._assign_values = {}
+        self._dirty_overriders = []
+        self._update_overriders = []
+        self._update_groups = {}
         tf_config = tf.ConfigProto(allow_soft_placement=True)
         tf_config.gpu_options.allow_growth = True
         self.tf_session = tf.Session(graph=self.tf_graph, config=tf_config)
         self.tf_session.mayo_session = self
         self.checkpoint = CheckpointHandler(
-            self.tf_session, config.system.search_path.checkpoint)
-        self.estimator = ResourceEstimator(config.system.batch_size_per_gpu)
+            self.tf_session, config.system.search_path.checkpoint,
+            config.system.get('checkpoint.save.background', False),
+            config.system.get('checkpoint.save.max_pending', 1))
+        self.estimator = ResourceEstimator(
+            config.system.batch_size_per_gpu,
+            format_interval=config.system.get('log.interval', 1))
         self._register_progress()
         self._instantiate_task()
         self._finalize()
@@ -104,6 +121,16 @@ class SessionBase(object, metaclass=SessionMeta):
             self.imgs_seen_op, 'imgs_seen',
             history=1, formatter=progress_formatter)
 
+    @memoize_property
+    def tracer(self):
+        layer_names = {
+            node.formatted_name()
+            for net in self.task.nets for node in net.layers()}
+        return StepTracer(
+            layer_names, self.config.system.search_path.profile[0],
+            self.config.system.get('trace.interval', 0),
+            self.config.system.get('trace.window', 10))
+
     @property
     def _task_constructor(self):
         return object_from_params(self.config.dataset.task)
@@ -154,6 +181,19 @@ class SessionBase(object, metaclass=SessionMeta):
     def imgs_seen(self):
         return self._tf_scalar('imgs_seen', tf.int64)
 
+    @memoize_property
+    def input_seed(self):
+        """
+        The seed of input shuffling, which is saved in checkpoints to
+        reproduce the order of examples when training resumes.
+        """
+        seed = self.config.system.get('preprocess.seed')
+        if seed is None:
+            seed = random.randrange(2 ** 31)
+        return tf.get_variable(
+            'mayo/input_seed', [], initializer=tf.constant_initializer(seed),
+            trainable=False, dtype=tf.int64)
+
     @memoize_property
     def imgs_seen_op(self):
         return tf.assign_add(self.imgs_seen, self.batch_size)
@@ -199,10 +239,54 @@ class SessionBase(object, metaclass=SessionMeta):
                     oresults[k] = getattr(o, func_name)()
         return results
 
+    def mark_overrider_dirty(self, overrider):
+        """
+        Marks `overrider` as having pending parameter assignments, so that
+        the next flush visits it.
+        """
+        if overrider not in self._dirty_overriders:
+            self._dirty_overriders.append(overrider)
+
     def _overrider_assign_parameters(self):
-        # parameter assignments in overriders
-        self._overriders_call('assign_parameters')
+        # parameter assignments in overriders, only overriders with pending
+        # parameter changes are visited
+        dirty_overriders = self._dirty_overriders
+        self._dirty_overriders = []
+        for o in dirty_overriders:
+            o.assign_parameters()
+            if not o._applied:
+                # not yet applied, keep its assignments pending
+                self._dirty_overriders.append(o)
         self._run_assignments()
+        # updates may depend on the assigned parameters
+        self._run_overrider_updates()
+
+    def mark_overrider_update(self, overrider):
+        """
+        Marks `overrider` as having a pending update operation, which is
+        run with other pending updates in a single group.
+        """
+        if overrider not in self._update_overriders:
+            self._update_overriders.append(overrider)
+
+    def _run_overrider_updates(self):
+        overriders = self._update_overriders
+        if not overriders:
+            return
+        self._update_overriders = []
+        key = frozenset(overriders)
+        try:
+            group = self._update_groups[key]
+        except KeyError:
+            ops = [o.update_op for o in overriders]
+            group = tf.group(*ops, name='mayo/update')
+            self._update_groups[key] = group
+        self._initialize_variables()
+        self.raw_run(group)
+        if log.is_enabled('debug'):
+            # info fetches masks to the host, so only when debugging
+            for o in overriders:
+                log.debug('Updated overrider {!r}.'.format(o.info()))
 
     def overriders_dump(self):
         data = self._overriders_call('dump')
@@ -220,11 +304,23 @@ class SessionBase(object, metaclass=SessionMeta):
     def load_checkpoint(self, name):
         # flush overrider parameter assignment
         self._overrider_assign_parameters()
-        # restore variables
-        restore_vars = self.checkpoint.load(name)
-        for v in restore_vars:
-            if v not in self.initialized_variables:
-                self.initialized_variables.append(v)
+        # restore variables and input iterator positions
+        for each in self.checkpoint.load(name):
+            initialized = self.initialized_variables
+            if isinstance(each, tf.data.Iterator):
+                # restored iterators continue from their saved positions
+                initialized = self.initialized_iterators
+            if each not in initialized:
+                initialized.append(each)
+        self._assign_sparse_weights()
+
+    def _assign_sparse_weights(self):
+        # fix sparse weights from the restored weights
+        sparse_weights = [
+            layer['weights'] for net in self.task.nets
+            for layer in net.sparse_layers.values()
+            if 'weights' in layer]
+        assign_sparse_weights(self, sparse_weights)
 
     @memoize_property
     def _config_var(self):
@@ -232,8 +328,51 @@ class SessionBase(object, metaclass=SessionMeta):
 
     def save_checkpoint(self, name):
         self._run_assignments()
+        self._run_overrider_updates()
         self.checkpoint.save(name)
 
+    def compact(self, key='compact'):
+        """
+        Removes channels pruned by channel pruners from the network, saves
+        the compacted variables as the checkpoint `key`, and returns the
+        compacted model definition.
+        """
+        net = self.task.nets[0]
+        masks = {}
+        packed = {}
+        for node, overriders in self.overriders.items():
+            for k, o in overriders.items():
+                if k == 'gradient':
+                    continue
+                for each in (o if isinstance(o, ChainOverrider) else [o]):
+                    if not isinstance(each, MaskPrunerBase):
+                        continue
+                    if each.packed:
+                        packed[each.mask.op.name] = each
+                    if k == 'activation' and \
+                            isinstance(each, ChannelPrunerBase):
+                        masks[node] = self.run(each.dense_mask)
+        compactor = ChannelCompactor(net, masks)
+        variables = self.global_variables()
+        values = self.run(variables)
+        values = {v.op.name: value for v, value in zip(variables, values)}
+        # packed masks are compacted as boolean masks
+        for name, o in packed.items():
+            values[name] = self.run(o.dense_mask)
+        # overridden weights fold constant pruned channels into biases
+        nodes = [n for n, v in net.variables.items() if 'weights' in v]
+        weights = self.run([net.variables[n]['weights'] for n in nodes])
+        weights = dict(zip(nodes, weights))
+        values = compactor.compact_values(values, weights)
+        for name in packed:
+            values[name] = util.pack_bits(values[name])
+        table = Table(['layer', 'channels', 'kept'])
+        for name, (channels, kept) in compactor.info().items():
+            table.add_row((name, channels, kept))
+        log.info('Compacted layers:\n{}'.format(table.format()))
+        self.checkpoint.save_values(key, values)
+        return compactor.compact_model(self.config.model.asdict(eval=False))
+
     def info(self, plumbing=False):
         return self.task.nets[0].info(plumbing)
 
@@ -282,13 +421,43 @@ class SessionBase(object, metaclass=SessionMeta):
             self._assign_operators[var] = op, placeholder
         self._assign_values[var] = tensor
 
+    def snapshot_variables(self, variables=None):
+        """
+        Takes an in-memory snapshot of the values of `variables`, which
+        defaults to all global variables.  Returns a mapping from variables
+        to their numpy values.
+        """
+        if variables is None:
+            variables = self.global_variables()
+        variables = list(variables)
+        self._initialize_variables()
+        values = self.run(variables)
+        return dict(zip(variables, values))
+
+    def restore_variables(self, snapshot):
+        """
+        Restores variables from a snapshot produced by `snapshot_variables`
+        with a single grouped assignment.
+        """
+        for var, value in snapshot.items():
+            self.assign(var, value)
+        self._run_assignments()
+        # sparse weights are not variables in snapshots, and are fixed
+        # again from the restored weights
+        self._assign_sparse_weights()
+
     def raw_run(self, ops, **kwargs):
         return self.tf_session.run(ops, **kwargs)
 
     def _initialize_variables(self):
         # ensure variables are initialized
+        global_vars = self.global_variables()
+        if len(global_vars) == self._num_checked_variables:
+            # variables are only ever added, and all of them have been
+            # initialized in the previous check
+            return
         uninit_vars = []
-        for var in self.global_variables():
+        for var in global_vars:
             if var not in self.initialized_variables:
                 uninit_vars.append(var)
         if uninit_vars:
@@ -296,43 +465,78 @@ class SessionBase(object, metaclass=SessionMeta):
             print_variables(desc, (v.op.name for v in uninit_vars), 'debug')
             self.raw_run(tf.variables_initializer(uninit_vars))
             self.initialized_variables += uninit_vars
+        self._num_checked_variables = len(global_vars)
+
+    def _initialize_iterators(self):
+        # iterators are initialized after variables, as they may capture
+        # variables such as the input seed
+        iterators = self.tf_graph.get_collection(self.iterators_collection)
+        uninit_iterators = [
+            i for i in iterators if i not in self.initialized_iterators]
+        if not uninit_iterators:
+            return
+        self.raw_run([i.initializer for i in uninit_iterators])
+        self.initialized_iterators += uninit_iterators
+
+    def _assign_group(self, variables):
+        """
+        A single grouped operation that performs the assignments of all
+        `variables`, the group is reused for the same set of variables.
+        """
+        key = frozenset(variables)
+        try:
+            return self._assign_groups[key]
+        except KeyError:
+            pass
+        ops = [self._assign_operators[v][0] for v in variables]
+        group = tf.group(*ops, name='mayo/assign')
+        self._assign_groups[key] = group
+        return group
 
     def _run_assignments(self):
         if not self._assign_values:
             return
-        assign_ops = []
         feed = {}
         tensor_feed = {}
         for var, value in self._assign_values.items():
-            op, placeholder = self._assign_operators[var]
-            assign_ops.append(op)
+            _, placeholder = self._assign_operators[var]
             if isinstance(value, (tf.Variable, tf.Tensor)):
                 tensor_feed[placeholder] = value
             else:
                 feed[placeholder] = value
-
         # ensure variables are assigned for evaluating tensors
         self._initialize_variables()
-        # eval tensors and update feed
-        tensor_feed = self.raw_run(tensor_feed)
-        feed.update(tensor_feed)
+        if tensor_feed:
+            # eval tensors and update feed, tensors are evaluated before any
+            # assignment takes place, as they may depend on the variables
+            # we assign to
+            feed.update(self.raw_run(tensor_feed))
         # assignment
-        self.raw_run(assign_ops, feed_dict=feed)
+        group = self._assign_group(self._assign_values)
+        self.raw_run(group, feed_dict=feed)
         self._assign_values = {}
 
     def run(self, ops, batch=False, **kwargs):
         self._initialize_variables()
+        self._initialize_iterators()
         self._overrider_assign_parameters()
         # session run
         if batch:
+            estimator = self.estimator
+            format_due = estimator.format_due()
+            trace_kwargs = self.tracer.run_options()
+            kwargs = dict(trace_kwargs, **kwargs)
             results, statistics = self.raw_run(
-                (ops, self.estimator.operations), **kwargs)
+                (ops, estimator.operations_due()), **kwargs)
+            if trace_kwargs:
+                self.tracer.add(kwargs['run_metadata'])
             # update statistics
-            self.estimator.append(statistics)
-            text = self.estimator.format(batch_size=self.batch_size)
-            log.info(text, update=True)
-            if log.is_enabled('debug'):
-                self.estimator.debug()
+            estimator.append(statistics)
+            if format_due:
+                text = estimator.format(batch_size=self.batch_size)
+                log.info(text, update=True)
+                if log.is_enabled('debug'):
+                    estimator.debug()
         else:
             results = self.raw_run(ops, **kwargs)
         return results
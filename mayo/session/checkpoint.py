@@ -1,12 +1,18 @@
 import os
 import re
 import glob
+import queue
+import atexit
+import threading
 
 import yaml
+import numpy as np
 import tensorflow as tf
+from tensorflow.python.ops import io_ops, gen_dataset_ops
 
 from mayo.log import log
 from mayo.util import format_shape, print_variables
+from mayo.override.util import pack_bits, unpack_bits
 
 
 class CheckpointNotFoundError(FileNotFoundError):
@@ -17,15 +23,141 @@ class CheckpointManifestNotFoundError(FileNotFoundError):
     pass
 
 
+def string_values(values):
+    """
+    The names, dtypes, shapes and values to write a mapping from names to
+    string `values`.
+    """
+    names = sorted(values)
+    return (
+        names, [tf.string] * len(names), [()] * len(names),
+        [values[n] for n in names])
+
+
+class BackgroundCheckpointWriter(object):
+    """
+    Serializes snapshots of variable values into checkpoints on a worker
+    thread.
+
+    Snapshots are written in the order they are submitted, and the manifest
+    is updated after each checkpoint is completely written, so that it
+    always points to a complete checkpoint.  At most `max_pending` snapshots
+    can be held in host memory, further submissions block until the worker
+    catches up.
+    """
+    def __init__(self, max_pending=1):
+        super().__init__()
+        self._queue = queue.Queue(maxsize=max(max_pending, 1))
+        self._thread = None
+        self._writers = {}
+
+    def _writer(self, names, dtypes, shapes):
+        # a private graph which saves fed values with the given names,
+        # we avoid `tf.train.Saver` as it only saves variables
+        key = (tuple(names), tuple(dtypes), tuple(shapes))
+        try:
+            return self._writers[key]
+        except KeyError:
+            pass
+        graph = tf.Graph()
+        with graph.as_default():
+            prefix = tf.placeholder(tf.string, shape=[], name='prefix')
+            placeholders = [
+                tf.placeholder(dtype, shape=shape)
+                for dtype, shape in zip(dtypes, shapes)]
+            save_op = io_ops.save_v2(
+                prefix, list(names), [''] * len(names), placeholders)
+        session = tf.Session(graph=graph)
+        writer = (session, prefix, placeholders, save_op)
+        self._writers[key] = writer
+        return writer
+
+    def write(self, path, names, dtypes, shapes, values):
+        """Writes `values` with `names` as the checkpoint `path`.  """
+        session, prefix, placeholders, save_op = \
+            self._writer(names, dtypes, shapes)
+        feed = dict(zip(placeholders, values))
+        feed[prefix] = path
+        session.run(save_op, feed_dict=feed)
+
+    def _write(
+            self, path, directory, names, dtypes, shapes, values,
+            inputs=None):
+        try:
+            if inputs:
+                # input iterator states are written before the checkpoint
+                # the manifest points to
+                self.write(*inputs)
+            self.write(path, names, dtypes, shapes, values)
+        except tf.errors.ResourceExhaustedError:
+            log.warn(
+                'Unable to save a checkpoint because we have '
+                'no space left on device.')
+            return
+        tf.train.update_checkpoint_state(directory, path)
+        log.debug('Checkpoint {!r} written in background.'.format(path))
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self._write(*job)
+            except Exception as e:
+                log.error(
+                    'Failed to write checkpoint {!r} in background: {}'
+                    .format(job[0], e))
+            finally:
+                self._queue.task_done()
+
+    def submit(
+            self, path, directory, variables, values,
+            inputs_path=None, inputs=None):
+        """
+        Submits the `values` of `variables` to be written as the checkpoint
+        `path`, along with the mapping `inputs` from names to serialized
+        input iterator states, written as the checkpoint `inputs_path`.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._work, daemon=True)
+            self._thread.start()
+            # pending checkpoints must be completed before we exit
+            atexit.register(self.wait)
+        names = [v.op.name for v in variables]
+        dtypes = [v.dtype.base_dtype for v in variables]
+        shapes = [tuple(v.shape.as_list()) for v in variables]
+        if inputs:
+            inputs = string_values(inputs)
+            inputs = (inputs_path, ) + inputs
+        self._queue.put(
+            (path, directory, names, dtypes, shapes, values, inputs))
+
+    def wait(self):
+        """Blocks until all submitted checkpoints are written.  """
+        if self._thread is None:
+            return
+        self._queue.join()
+
+
 class CheckpointHandler(object):
     _checkpoint_basename = 'checkpoint'
     _checkpoint_latest = 'latest'
+    # input iterators whose positions are saved along with checkpoints
+    iterators_collection = 'mayo.checkpoint.iterators'
 
-    def __init__(self, session, search_path):
+    def __init__(self, session, search_path, background=False, max_pending=1):
         super().__init__()
         self.tf_session = session
         self._search_path = search_path
         self._checkpoint_directories = {}
+        self._savers = {}
+        self._variable_maps = {}
+        self._restore_plans = {}
+        self._iterator_ops = {}
+        self._writer = None
+        # writes values in the foreground
+        self._value_writer = BackgroundCheckpointWriter()
+        if background:
+            self._writer = BackgroundCheckpointWriter(max_pending)
 
     def _directory(self, is_saving):
         try:
@@ -90,27 +222,173 @@ class CheckpointHandler(object):
         with self.tf_session.graph.as_default():
             return tf.global_variables()
 
-    def load(self, key=_checkpoint_latest):
-        if key is False or (key != 0 and not key):
-            log.debug('Checkpoint loading disabled.')
-            return []
+    def _saver(self, variables):
+        key = tuple(variables)
         try:
-            path = self._path(key, False)
-        except CheckpointManifestNotFoundError as e:
-            log.warn('{} Abort load.'.format(e))
+            return self._savers[key]
+        except KeyError:
+            pass
+        with self.tf_session.graph.as_default():
+            # max_to_keep=None, as we keep all checkpoints on disk
+            saver = tf.train.Saver(variables, max_to_keep=None)
+        self._savers[key] = saver
+        return saver
+
+    def wait(self):
+        """Blocks until all checkpoints saved in background are written.  """
+        if self._writer:
+            self._writer.wait()
+
+    def _iterators(self):
+        with self.tf_session.graph.as_default():
+            return tf.get_collection(self.iterators_collection)
+
+    def _iterator_state_ops(self, iterator):
+        """
+        The name of the state of `iterator` in checkpoints, and the ops to
+        serialize its state into a string and to restore it from a fed
+        string, which let states be fetched for background writing.
+        """
+        try:
+            return self._iterator_ops[iterator]
+        except KeyError:
+            pass
+        with self.tf_session.graph.as_default():
+            resource = iterator._iterator_resource
+            state = tf.serialize_tensor(
+                gen_dataset_ops.serialize_iterator(resource))
+            placeholder = tf.placeholder(tf.string, shape=[])
+            restore = gen_dataset_ops.deserialize_iterator(
+                resource, tf.parse_tensor(placeholder, tf.variant))
+        name = '{}/state'.format(resource.op.name)
+        ops = (name, state, placeholder, restore)
+        self._iterator_ops[iterator] = ops
+        return ops
+
+    @staticmethod
+    def _iterator_path(path):
+        return '{}.input'.format(path)
+
+    def _load_iterators(self, path):
+        """
+        Restores the positions of input iterators saved along with the
+        checkpoint at `path`, and returns the restored iterators.
+        """
+        iterators = self._iterators()
+        path = self._iterator_path(path)
+        if not iterators or not os.path.exists(path + '.index'):
             return []
+        var_map = self._variable_map(path)
+        reader = tf.train.NewCheckpointReader(path)
+        restore_iterators = []
+        restore_ops = []
+        feed_dict = {}
+        for i in iterators:
+            name, _, placeholder, restore = self._iterator_state_ops(i)
+            if name not in var_map:
+                log.warn(
+                    'Position of input iterator {!r} not found in '
+                    'checkpoint, reading inputs from the beginning.'
+                    .format(name))
+                continue
+            feed_dict[placeholder] = reader.get_tensor(name)
+            restore_ops.append(restore)
+            restore_iterators.append(i)
+        if not restore_iterators:
+            return []
+        self.tf_session.run(restore_ops, feed_dict=feed_dict)
+        log.debug('Input iterator positions restored.')
+        return restore_iterators
+
+    def _iterator_states(self):
+        """
+        A mapping from names to serialized states of input iterators.
+        """
+        ops = {}
+        for i in self._iterators():
+            name, state, _, _ = self._iterator_state_ops(i)
+            ops[name] = state
+        if not ops:
+            return {}
+        return self.tf_session.run(ops)
+
+    def _variable_map(self, path):
+        """
+        Returns a mapping from variable names to their (shape, dtype)
+        in the checkpoint at `path`, the mapping is cached until
+        the checkpoint is overwritten.
+        """
+        mtime = os.path.getmtime(path + '.index')
+        cached = self._variable_maps.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
         reader = tf.train.NewCheckpointReader(path)
         var_shape_map = reader.get_variable_to_shape_map()
         var_dtype_map = reader.get_variable_to_dtype_map()
+        var_map = {
+            name: (tuple(shape), var_dtype_map[name].base_dtype)
+            for name, shape in var_shape_map.items()}
+        self._variable_maps[path] = (mtime, var_map)
+        return var_map
+
+    @staticmethod
+    def _mask_converter(variable, shape, dtype):
+        """
+        Returns a function which converts a mask of `shape` and `dtype` in
+        checkpoint between the dense and the bit-packed forms to match
+        `variable`, or None if no conversion applies.
+        """
+        if not variable.op.name.endswith('.mask'):
+            return None
+        v_shape = variable.shape.as_list()
+        v_dtype = variable.dtype.base_dtype
+        if v_dtype == tf.uint8 and dtype == tf.bool:
+            # a dense mask loaded into a packed mask
+            if v_shape == [-(-int(np.prod(shape)) // 8)]:
+                return pack_bits
+        elif v_dtype == tf.bool and dtype == tf.uint8:
+            # a packed mask loaded into a dense mask
+            if list(shape) == [-(-int(np.prod(v_shape)) // 8)]:
+                return lambda value: unpack_bits(value, v_shape)
+        return None
+
+    def _restore_plan(self, path):
+        """
+        Matches the graph variables against the variables in the
+        checkpoint at `path`, and returns the variables to restore, and
+        the variables to restore with values converted by functions.
+        Checkpoints with identical variable signatures, e.g. checkpoints
+        from different epochs of the same model, share the same plan.
+        """
+        var_map = self._variable_map(path)
+        variables = tuple(self._global_variables())
+        key = (frozenset(var_map.items()), variables)
+        try:
+            plan = self._restore_plans[key]
+        except KeyError:
+            pass
+        else:
+            log.debug(
+                'Reusing the restore plan of {} variables.'
+                .format(sum(len(p) for p in plan)))
+            return plan
         restore_vars = []
+        convert_vars = []
         missing_vars = []
-        for v in self._global_variables():
+        for v in variables:
             base_name, _ = v.name.split(':')
-            shape = var_shape_map.get(base_name, None)
+            shape, dtype = var_map.get(base_name, (None, None))
             if shape is None:
                 missing_vars.append(base_name)
                 continue
-            v_shape = v.shape.as_list()
+            convert = self._mask_converter(v, shape, dtype)
+            if convert is not None:
+                log.debug(
+                    'Converting the packing of mask {!r} from checkpoint.'
+                    .format(base_name))
+                convert_vars.append((v, convert))
+                continue
+            v_shape = tuple(v.shape.as_list())
             if shape != v_shape:
                 v_shape = format_shape(v_shape)
                 shape = format_shape(shape)
@@ -119,7 +397,6 @@ class CheckpointHandler(object):
                     'the shape ({}) in checkpoint, not loading it.'
                     .format(base_name, v_shape, shape))
                 continue
-            dtype = var_dtype_map.get(base_name, None).base_dtype
             v_dtype = v.dtype.base_dtype
             if dtype != v_dtype:
                 log.warn(
@@ -129,11 +406,10 @@ class CheckpointHandler(object):
                 continue
             restore_vars.append(v)
         # variable not restored
-        not_restore_vars = []
-        restore_var_names = [v.name.split(':')[0] for v in restore_vars]
-        for v in var_shape_map:
-            if v not in restore_var_names:
-                not_restore_vars.append(v)
+        restore_var_names = {
+            v.name.split(':')[0]
+            for v in restore_vars + [v for v, _ in convert_vars]}
+        not_restore_vars = [v for v in var_map if v not in restore_var_names]
         desc = 'Variables in checkpoint but not restored'
         print_variables(desc, not_restore_vars, 'warn')
         # variables missing
@@ -141,12 +417,53 @@ class CheckpointHandler(object):
         print_variables(desc, missing_vars, 'warn')
         # variables to restore
         desc = 'Checkpoint variables to restore'
-        print_variables(desc, (v.name for v in restore_vars), 'debug')
+        print_variables(desc, [v.name for v in restore_vars], 'debug')
+        plan = (restore_vars, convert_vars)
+        self._restore_plans[key] = plan
+        return plan
+
+    def load(self, key=_checkpoint_latest):
+        """
+        Restores variables and input iterator positions from the checkpoint
+        `key`, and returns the restored variables and iterators.
+        """
+        if key is False or (key != 0 and not key):
+            log.debug('Checkpoint loading disabled.')
+            return []
+        # ensure checkpoints saved in background are complete
+        self.wait()
+        try:
+            path = self._path(key, False)
+        except CheckpointManifestNotFoundError as e:
+            log.warn('{} Abort load.'.format(e))
+            return []
+        restore_vars, convert_vars = self._restore_plan(path)
         # restore
-        restorer = tf.train.Saver(restore_vars)
-        restorer.restore(self.tf_session, path)
+        if restore_vars:
+            restorer = self._saver(restore_vars)
+            restorer.restore(self.tf_session, path)
+        if convert_vars:
+            reader = tf.train.NewCheckpointReader(path)
+            for v, convert in convert_vars:
+                value = convert(reader.get_tensor(v.op.name))
+                v.load(value, self.tf_session)
+            restore_vars = restore_vars + [v for v, _ in convert_vars]
         log.debug('Checkpoint restored.')
-        return restore_vars
+        return restore_vars + self._load_iterators(path)
+
+    def save_values(self, key, values):
+        """
+        Saves a mapping from variable names to numpy array `values` as the
+        checkpoint `key`, e.g. for variables with shapes that differ from
+        the graph.  The checkpoint does not become the latest checkpoint.
+        """
+        cp_path = self._path(key, True)
+        log.info('Saving checkpoint to {!r}...'.format(cp_path))
+        names = sorted(values)
+        values = [np.asarray(values[n]) for n in names]
+        dtypes = [tf.as_dtype(v.dtype) for v in values]
+        shapes = [v.shape for v in values]
+        self._value_writer.write(cp_path, names, dtypes, shapes, values)
 
     def save(self, key):
         cp_path = self._path(key, True)
@@ -156,8 +473,24 @@ class CheckpointHandler(object):
                 .format(key, cp_path))
         else:
             log.info('Saving checkpoint to {!r}...'.format(cp_path))
+        variables = self._global_variables()
+        # iterator states are serialized in the foreground, as they
+        # change with each step
+        inputs = self._iterator_states()
+        inputs_path = self._iterator_path(cp_path)
+        if self._writer:
+            # snapshot variables into host memory, and write them
+            # in background
+            values = self.tf_session.run(variables)
+            directory = self._directory(True)
+            self._writer.submit(
+                cp_path, directory, variables, values, inputs_path, inputs)
+            return
         try:
-            saver = tf.train.Saver(self._global_variables())
+            if inputs:
+                self._value_writer.write(
+                    inputs_path, *string_values(inputs))
+            saver = self._saver(variables)
             saver.save(self.tf_session, cp_path, write_meta_graph=False)
         except tf.errors.ResourceExhaustedError:
             log.warn(
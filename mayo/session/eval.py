@@ -1,3 +1,4 @@
+import copy
 import math
 
 from mayo.log import log
@@ -44,22 +45,87 @@ class Evaluate(SessionBase):
                 continue
             yield e
 
+    def _eval_state(self):
+        state = {'statistics': self.estimator.statistics}
+        for attr in self.task.eval_state_attributes:
+            state[attr] = getattr(self.task, attr)
+        return state
+
+    def _set_eval_state(self, state):
+        self.estimator.statistics = state['statistics']
+        for attr in self.task.eval_state_attributes:
+            setattr(self.task, attr, state[attr])
+
+    def eval_multiple(self, keys, batches_per_chunk=10):
+        """
+        Evaluates multiple checkpoints in a single pass over the validation
+        set.  Input batches are read in chunks of `batches_per_chunk`, and
+        each chunk is fed to every checkpoint in turn, swapping variables
+        from in-memory snapshots.  Returns a list of evaluation results.
+        """
+        if not self.task.eval_state_attributes:
+            raise NotImplementedError(
+                'Task {!r} does not support evaluating multiple checkpoints '
+                'in one pass.'.format(self.task))
+        initial_state = copy.deepcopy(self._eval_state())
+        states = []
+        for key in keys:
+            self.load_checkpoint(key)
+            self.run(self.imgs_seen.initializer)
+            state = copy.deepcopy(initial_state)
+            state['snapshot'] = self.snapshot_variables()
+            states.append(state)
+        inputs = list(self.task._preprocessor.batch)
+        num_iterations = math.ceil(self.num_examples / self.batch_size)
+        log.info(
+            'Starting evaluation of {} checkpoints...'.format(len(keys)))
+        chunk = []
+        for step in range(num_iterations):
+            chunk.append(self.raw_run(inputs))
+            if len(chunk) < batches_per_chunk and step < num_iterations - 1:
+                continue
+            for state in states:
+                self._set_eval_state(state)
+                self.restore_variables(state['snapshot'])
+                for values in chunk:
+                    feed_dict = dict(zip(inputs, values))
+                    self.run([], batch=True, feed_dict=feed_dict)
+                state.update(self._eval_state())
+                # only the progress changes during evaluation
+                state['snapshot'][self.imgs_seen] = \
+                    self.raw_run(self.imgs_seen)
+            chunk = []
+        log.info('Evaluation complete.')
+        results = []
+        for state in states:
+            self._set_eval_state(state)
+            results.append(self.task.post_eval())
+        return results
+
     def eval_all(self):
         log.info('Evaluating all checkpoints...')
         epochs = list(self._range(self.checkpoint.list_epochs()))
         epochs_to_eval = ', '.join(str(e) for e in epochs)
         log.info('Checkpoints to evaluate: {}'.format(epochs_to_eval))
         table = None
+        num_per_pass = self.config.get('eval.checkpoints_per_pass', 1)
+        batches_per_chunk = self.config.get('eval.batches_per_chunk', 10)
         # ensures imgs_seen initialized and loaded
         try:
-            for e in epochs:
+            for i in range(0, len(epochs), num_per_pass):
+                group = epochs[i:i + num_per_pass]
                 with log.demote():
-                    stats = self.eval(e, keyboard_interrupt=False)
-                table = table or Table(['epoch'] + list(sorted(stats)))
-                table.add_row(dict({'epoch': e}, **stats))
-                infos = ['epoch: {}'.format(e)]
-                infos += ['{}: {}'.format(k, v) for k, v in stats.items()]
-                log.info(', '.join(infos))
+                    if num_per_pass > 1:
+                        results = self.eval_multiple(group, batches_per_chunk)
+                    else:
+                        results = [
+                            self.eval(group[0], keyboard_interrupt=False)]
+                for e, stats in zip(group, results):
+                    table = table or Table(['epoch'] + list(sorted(stats)))
+                    table.add_row(dict({'epoch': e}, **stats))
+                    infos = ['epoch: {}'.format(e)]
+                    infos += ['{}: {}'.format(k, v) for k, v in stats.items()]
+                    log.info(', '.join(infos))
         except KeyboardInterrupt:
             pass
         return table
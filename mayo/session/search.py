@@ -1,13 +1,137 @@
 import re
 import math
+import pickle
+import collections
+import multiprocessing
 
+import yaml
 import tensorflow as tf
 
 from mayo.log import log
-from mayo.util import memoize_property
+from mayo.util import memoize_property, memoize_method
+from mayo.override.base import OverriderBase
 from mayo.session.train import Train
 
 
+def _candidate_worker(config_yaml, connection):
+    """
+    Worker process which fine-tunes candidate hyperparameters on CPU.
+    """
+    from mayo.config import Config
+    config = Config()
+    config.merge(yaml.load(config_yaml))
+    config.merge({
+        'system': {
+            'visible_gpus': [],
+            'checkpoint': {'load': False, 'save': False},
+        },
+        'search': {'parallel': {'num_workers': 0}},
+    })
+    session = Search(config)
+    variables = {v.op.name: v for v in session.global_variables()}
+    # the variable values each candidate starts from
+    initial = {}
+    while True:
+        command, *args = connection.recv()
+        if command == 'stop':
+            break
+        if command == 'restore':
+            values = pickle.loads(args[0])
+            initial = {
+                variables[name]: value for name, value in values.items()
+                if name in variables}
+        elif command == 'evaluate':
+            tolerable_baseline, assignments = args
+            session.tolerable_baseline = tolerable_baseline
+            session.restore_variables(initial)
+            for name, value in assignments.items():
+                session.assign(variables[name], value)
+            with log.demote():
+                accuracy = session.fine_tune_accuracy()
+            connection.send(accuracy)
+        elif command == 'fetch':
+            names = [n for n in args[0] if n in variables]
+            snapshot = session.snapshot_variables(
+                [variables[n] for n in names])
+            connection.send({
+                v.op.name: value for v, value in snapshot.items()})
+        else:
+            raise ValueError(
+                'Unrecognized worker command {!r}.'.format(command))
+    connection.close()
+
+
+class CandidatePool(object):
+    """
+    A pool of worker processes, each holds its own copy of the model to
+    fine-tune candidate hyperparameters.
+    """
+    def __init__(self, config, num_workers):
+        super().__init__()
+        log.info(
+            'Starting {} worker processes for candidate evaluation...'
+            .format(num_workers))
+        # tensorflow is not fork-safe
+        context = multiprocessing.get_context('spawn')
+        config_yaml = config.to_yaml()
+        self._connections = []
+        self._processes = []
+        for _ in range(num_workers):
+            connection, worker_connection = context.Pipe()
+            process = context.Process(
+                target=_candidate_worker,
+                args=(config_yaml, worker_connection), daemon=True)
+            process.start()
+            self._connections.append(connection)
+            self._processes.append(process)
+
+    def restore(self, values):
+        """
+        Sets the variable values which workers start fine-tuning each
+        candidate from, `values` maps variable names to their values.
+        """
+        # pickled once for all workers
+        payload = pickle.dumps(values, pickle.HIGHEST_PROTOCOL)
+        for connection in self._connections:
+            connection.send(('restore', payload))
+
+    def evaluate(self, tolerable_baseline, candidates):
+        """
+        Fine-tunes each candidate in a separate worker, from the variable
+        values last given to `.restore()`.
+
+        tolerable_baseline: the tolerable accuracy.
+        candidates:
+            a list of mappings from hyperparameter variable names to
+            their candidate values.
+        returns: the fine-tuned accuracy of each candidate.
+        """
+        if len(candidates) > len(self._connections):
+            raise ValueError(
+                'We have more candidates than workers to evaluate them.')
+        connections = self._connections[:len(candidates)]
+        for connection, assignments in zip(connections, candidates):
+            connection.send(('evaluate', tolerable_baseline, assignments))
+        return [connection.recv() for connection in connections]
+
+    def fetch(self, index, names):
+        """
+        Returns the values of variables with `names` in the worker that
+        evaluated the candidate at `index`.
+        """
+        connection = self._connections[index]
+        connection.send(('fetch', names))
+        return connection.recv()
+
+    def close(self):
+        for connection in self._connections:
+            connection.send(('stop', ))
+        for process in self._processes:
+            process.join()
+        self._connections = []
+        self._processes = []
+
+
 class SearchBase(Train):
     def _profile(self):
         baseline = self.config.search.accuracy.get('baseline')
@@ -66,6 +190,11 @@ class SearchBase(Train):
             raise ValueError(
                 'No search target hyperparameter specified. '
                 'Perhaps your regex is not written correctly?')
+        self.candidate_pool = None
+        if self.num_workers:
+            self.candidate_pool = CandidatePool(self.config, self.num_workers)
+            # workers receive variable values only when they change
+            self._candidate_pool_stale = True
         # initialize hyperparameters to starting positions
         # FIXME how can we continue search?
         for _, info in self.targets.items():
@@ -99,18 +228,86 @@ class SearchBase(Train):
             return self._step_forward(value, end, new_step, min_step, dtype)
         return new_value
 
+    _write_op_prefixes = (
+        'Assign', 'Apply', 'ResourceApply', 'Scatter', 'ResourceScatter')
+
+    @staticmethod
+    def _flatten_fetches(fetches):
+        if isinstance(fetches, collections.Mapping):
+            fetches = list(fetches.values())
+        if isinstance(fetches, (list, tuple)):
+            for f in fetches:
+                yield from SearchBase._flatten_fetches(f)
+        elif isinstance(fetches, (tf.Tensor, tf.Variable)):
+            yield fetches.op
+        elif isinstance(fetches, tf.Operation):
+            yield fetches
+
+    @memoize_method
+    def _written_variables(self):
+        """
+        Variables written by the operations that fine-tuning runs.
+        """
+        # all operations that fine-tuning depends on
+        fetches = [self.num_epochs, self._train_op, self.estimator.operations]
+        todo = list(self._flatten_fetches(fetches))
+        ops = set()
+        while todo:
+            op = todo.pop()
+            if op in ops:
+                continue
+            ops.add(op)
+            todo += [t.op for t in op.inputs]
+            todo += op.control_inputs
+        # variables written by these operations
+        written_ops = set()
+        for op in ops:
+            if op.inputs and op.type.startswith(self._write_op_prefixes):
+                written_ops.add(op.inputs[0].op)
+        return [v for v in self.global_variables() if v.op in written_ops]
+
+    def _touched_variables(self):
+        """
+        Variables that fine-tuning could modify, i.e. variables written by
+        the operations it runs, variables modified by overriders, and
+        variables updated by assignments.  Assignment targets can be added
+        at any time, so they are collected on each call.
+        """
+        touched = list(self._written_variables())
+        others = tf.get_collection(OverriderBase.variables_collection)
+        others += list(self._assign_operators)
+        others += [info['variable'] for info in self.targets.values()]
+        for v in others:
+            if v not in touched:
+                touched.append(v)
+        log.debug(
+            'Backtracking snapshots {} out of {} variables.'
+            .format(len(touched), len(self.global_variables())))
+        return touched
+
     def backtrack(self):
         log.debug('Reverting to the last hyperparameters.')
         self.targets = self.backtrack_targets
-        self.load_checkpoint('backtrack')
+        if self.config.search.get('backtrack.checkpoint', False):
+            self.load_checkpoint('backtrack')
+            return
+        self._overrider_assign_parameters()
+        self.restore_variables(self._backtrack_snapshot)
 
     def set_backtrack_to_here(self):
         self.backtrack_targets = {}
         for node, info in self.targets.items():
             self.backtrack_targets[node] = dict(info)
-        self.save_checkpoint('backtrack')
+        if self.config.search.get('backtrack.checkpoint', False):
+            self.save_checkpoint('backtrack')
+            return
+        self._run_assignments()
+        variables = None
+        if self.config.search.get('backtrack.variables', 'all') == 'touched':
+            variables = self._touched_variables()
+        self._backtrack_snapshot = self.snapshot_variables(variables)
 
-    def fine_tune(self):
+    def fine_tune_accuracy(self):
         self.reset_num_epochs()
         self.overriders_update()
         max_epoch = self.config.search.max_epochs.fine_tune
@@ -119,7 +316,10 @@ class SearchBase(Train):
             epoch, _ = self.run([self.num_epochs, self._train_op], batch=True)
             total_accuracy += self.estimator.get_value('accuracy', 'train')
             step += 1
-        accuracy = total_accuracy / step
+        return total_accuracy / step
+
+    def fine_tune(self):
+        accuracy = self.fine_tune_accuracy()
         if accuracy >= self.tolerable_baseline:
             log.debug(
                 'Fine-tuned accuracy {!r} found tolerable.'
@@ -139,14 +339,108 @@ class SearchBase(Train):
         # main procedure
         max_steps = self.config.search.max_steps
         step = 0
-        while True:
-            if max_steps and step > max_steps:
-                break
-            step += 1
-            if not self.kernel():
-                break
+        try:
+            while True:
+                if max_steps and step > max_steps:
+                    break
+                step += 1
+                if not self.kernel():
+                    break
+        finally:
+            if self.candidate_pool:
+                self.candidate_pool.close()
         log.info('Automated hyperparameter optimization complete.')
 
+    @property
+    def num_workers(self):
+        return self.config.search.get('parallel.num_workers', 0)
+
+    def _candidates(self, nodes):
+        """
+        Produces up to `self.num_workers` candidate hyperparameter values for
+        `nodes`, each uses step sizes reduced once more than the previous,
+        as successive retries in the sequential search would do.
+
+        Returns the candidates, the step sizes to use if no candidate
+        is tolerable, and whether we can no longer step further.
+        """
+        steps = {n: self.targets[n]['step'] for n in nodes}
+        candidates = []
+        while len(candidates) < self.num_workers:
+            for n in nodes:
+                if abs(steps[n]) < abs(self.targets[n]['min_step']):
+                    return candidates, steps, True
+            values = {}
+            for n in nodes:
+                info = self.targets[n]
+                value = self._step_forward(
+                    info['from'], info['to'], steps[n],
+                    info['min_step'], info['type'])
+                if value is False:
+                    return candidates, steps, True
+                values[n] = value
+            candidates.append((values, dict(steps)))
+            steps = {
+                n: self._reduce_step(s, self.targets[n]['type'])
+                for n, s in steps.items()}
+        return candidates, steps, False
+
+    def parallel_fine_tune(self, nodes):
+        """
+        Fine-tunes candidate hyperparameter values for `nodes` in parallel
+        worker processes, each from the current variable values, and
+        commits the most aggressive tolerable candidate.
+
+        Returns True if a candidate is committed, False if none is
+        tolerable, and None if we can no longer step further.
+        """
+        candidates, next_steps, exhausted = self._candidates(nodes)
+        if not candidates:
+            return None
+        pool = self.candidate_pool
+        if self._candidate_pool_stale:
+            pool.restore({
+                v.op.name: value
+                for v, value in self.snapshot_variables().items()})
+            self._candidate_pool_stale = False
+        jobs = []
+        for values, _ in candidates:
+            jobs.append({
+                self.targets[n]['variable'].op.name: value
+                for n, value in values.items()})
+        log.info(
+            'Fine-tuning {} candidates in parallel...'.format(len(jobs)))
+        accuracies = pool.evaluate(self.tolerable_baseline, jobs)
+        iterer = enumerate(zip(candidates, accuracies))
+        for index, ((values, steps), accuracy) in iterer:
+            log.debug(
+                'Candidate {} has a fine-tuned accuracy {!r}.'
+                .format(index, accuracy))
+            if accuracy < self.tolerable_baseline:
+                continue
+            # commit the candidate with the largest step sizes, only
+            # variables that fine-tuning could modify differ
+            variables = {v.op.name: v for v in self._touched_variables()}
+            fetched = pool.fetch(index, list(variables))
+            self.restore_variables({
+                variables[name]: value for name, value in fetched.items()})
+            self._candidate_pool_stale = True
+            for n, value in values.items():
+                info = self.targets[n]
+                info['from'] = value
+                info['step'] = steps[n]
+                log.info(
+                    'Updated hyperparameter {!r} in layer {!r} with a new '
+                    'value {}.'.format(
+                        info['variable'].op.name, n.formatted_name(), value))
+            self.set_backtrack_to_here()
+            return True
+        if exhausted:
+            return None
+        for n, step in next_steps.items():
+            self.targets[n]['step'] = step
+        return False
+
 
 class Search(SearchBase):
     def _init_search(self):
@@ -185,6 +479,14 @@ class Search(SearchBase):
         log.debug(
             'Prioritize layer {!r} with importance {}.'
             .format(node_name, node_priority))
+        if self.num_workers:
+            tolerable = self.parallel_fine_tune([node])
+            if tolerable is None:
+                log.debug(
+                    'Blacklisting {!r} as we cannot further '
+                    'increment/decrement.'.format(node_name))
+                self.blacklist.add(node)
+            return True
         value = self._step_forward(
             info['from'], info['to'], info['step'],
             info['min_step'], info['type'])
@@ -219,6 +521,12 @@ class Search(SearchBase):
         return True
 
     def global_kernel(self):
+        if self.num_workers:
+            if self.parallel_fine_tune(list(self.targets)) is None:
+                log.debug(
+                    'Stopping as we cannot further increment/decrement.')
+                return False
+            return True
         for node, info in self.targets.items():
             node_name = node.formatted_name()
             value = self._step_forward(
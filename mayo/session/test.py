@@ -1,6 +1,55 @@
+import os
+import csv
+import json
+
+import tensorflow as tf
+
+from mayo.log import log
 from mayo.session.base import SessionBase
 
 
+class ResultWriter(object):
+    """
+    Writes test results incrementally as JSON lines or CSV rows, so that
+    results never accumulate in memory.
+    """
+    formats = ['jsonl', 'csv']
+
+    def __init__(self, path, format='jsonl'):
+        super().__init__()
+        if format not in self.formats:
+            raise ValueError(
+                'Unrecognized test output format {!r}.'.format(format))
+        self.format = format
+        self.path = path
+        self.num_results = 0
+        self._file = open(path, 'w', newline='')
+        self._csv = None
+
+    def _write_csv(self, result):
+        if self._csv is None:
+            self._csv = csv.DictWriter(self._file, list(result))
+            self._csv.writeheader()
+        # nested values, e.g. detections, are encoded as JSON
+        result = {
+            k: v if isinstance(v, (str, int, float)) else json.dumps(v)
+            for k, v in result.items()}
+        self._csv.writerow(result)
+
+    def write(self, results):
+        for result in results:
+            if self.format == 'csv':
+                self._write_csv(result)
+            else:
+                self._file.write(json.dumps(result))
+                self._file.write('\n')
+        self.num_results += len(results)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
 class Test(SessionBase):
     mode = 'test'
 
@@ -8,8 +57,27 @@ class Test(SessionBase):
         super().__init__(config)
         self.load_checkpoint(self.config.system.checkpoint.load)
 
+    def _writer(self):
+        format = self.config.system.get('test.format', 'jsonl')
+        output_dir = self.config.system.search_path.run.outputs[0]
+        os.makedirs(output_dir, exist_ok=True)
+        path = os.path.join(output_dir, 'predictions.{}'.format(format))
+        return ResultWriter(path, format)
+
     def test(self):
         todo = list(zip(self.task.names, self.task.predictions))
-        results = self.run(todo, batch=True)
-        for names, predictions in results:
-            self.task.test(names, predictions)
+        writer = self._writer()
+        try:
+            # results are written as batches finish
+            while True:
+                try:
+                    results = self.run(todo, batch=True)
+                except tf.errors.OutOfRangeError:
+                    break
+                for names, predictions in results:
+                    writer.write(self.task.test(names, predictions))
+        finally:
+            writer.close()
+        log.info(
+            'Results of {} images saved in {!r}.'
+            .format(writer.num_results, writer.path))
@@ -0,0 +1,123 @@
+import os
+import json
+import collections
+
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+from mayo.log import log
+from mayo.util import Percent, Table
+
+
+class StepTracer(object):
+    """
+    Captures the run metadata of session steps at an interval, and
+    aggregates per-op and per-layer compute time over a rolling window of
+    the most recent traces.
+
+    Every `window` traces, a merged chrome trace `timeline.json` and a
+    per-layer cost table `layers.txt` are written to `path`.
+    """
+    def __init__(self, layer_names, path, interval=0, window=10):
+        super().__init__()
+        self.interval = interval
+        self.window = max(window, 1)
+        self.path = path
+        self.step = 0
+        self._num_traces = 0
+        self._traces = collections.deque(maxlen=self.window)
+        # match the longest layer scope first, as scopes may be nested
+        self._layer_names = sorted(layer_names, key=len, reverse=True)
+        self._op_layers = {}
+
+    def run_options(self):
+        """
+        Keyword arguments for `tf.Session.run` of the current step, which
+        requests a full trace if the step is due.
+        """
+        self.step += 1
+        if not self.interval or self.step % self.interval:
+            return {}
+        return {
+            'options': tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+            'run_metadata': tf.RunMetadata(),
+        }
+
+    def add(self, run_metadata):
+        self._traces.append(run_metadata.step_stats)
+        self._num_traces += 1
+        if self._num_traces % self.window == 0:
+            self.save()
+
+    def _layer(self, op_name):
+        layer = self._op_layers.get(op_name)
+        if layer is not None:
+            return layer
+        layer = 'others'
+        wrapped_op_name = '/{}/'.format(op_name)
+        for name in self._layer_names:
+            if '/{}/'.format(name) in wrapped_op_name:
+                layer = name
+                break
+        self._op_layers[op_name] = layer
+        return layer
+
+    def op_times(self):
+        """
+        The average time in microseconds spent by each op per traced step.
+        """
+        times = collections.Counter()
+        for step_stats in self._traces:
+            for dev_stats in step_stats.dev_stats:
+                device = dev_stats.device
+                if '/stream:' in device and not device.endswith('/stream:all'):
+                    # per-stream stats duplicate those in 'stream:all'
+                    continue
+                for node_stats in dev_stats.node_stats:
+                    op_name = node_stats.node_name.split(':')[0]
+                    times[op_name] += node_stats.all_end_rel_micros
+        num_traces = len(self._traces)
+        return {op: time / num_traces for op, time in times.items()}
+
+    def layer_times(self, op_times=None):
+        times = collections.Counter()
+        for op, time in (op_times or self.op_times()).items():
+            times[self._layer(op)] += time
+        return times
+
+    def _table(self, times, header):
+        total = sum(times.values())
+        table = Table([header, 'time (ms)', 'percent'])
+        for name, time in sorted(times.items(), key=lambda i: -i[1]):
+            percent = Percent(time / total if total else 0)
+            table.add_row((name, time / 1000.0, percent))
+        table.footer_sum('time (ms)')
+        return table
+
+    def chrome_trace(self):
+        """
+        A chrome trace merged from traces in the window.
+        """
+        events = []
+        for step_stats in self._traces:
+            trace = timeline.Timeline(step_stats)
+            trace = json.loads(trace.generate_chrome_trace_format())
+            events += trace['traceEvents']
+        return {'traceEvents': events}
+
+    def save(self):
+        if not self._traces:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, 'timeline.json'), 'w') as f:
+            json.dump(self.chrome_trace(), f)
+        op_times = self.op_times()
+        layer_table = self._table(self.layer_times(op_times), 'layer')
+        op_table = self._table(op_times, 'op')
+        with open(os.path.join(self.path, 'layers.txt'), 'w') as f:
+            f.write(layer_table.format())
+            f.write('\n')
+            f.write(op_table.format())
+        log.debug(
+            'Saved {} merged traces to {!r}.'
+            .format(len(self._traces), self.path))
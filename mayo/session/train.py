@@ -132,6 +132,8 @@ class Train(SessionBase):
     def overriders_update(self):
         log.info('Updating overrider internal variables...')
         self._overriders_call('update')
+        # run pending update operations of all overriders together
+        self._overrider_assign_parameters()
 
     def overriders_reset(self):
         log.info('Resetting overriders internal variables...')
@@ -173,3 +175,5 @@ class Train(SessionBase):
                 countdown = save.get('countdown', 0)
                 if log.countdown('Saving checkpoint', countdown):
                     self.save_checkpoint('latest')
+        # wait for checkpoints written in background
+        self.checkpoint.wait()
@@ -1,4 +1,5 @@
 import os
+import glob
 import collections
 from contextlib import contextmanager
 
@@ -12,6 +13,10 @@ from mayo.session.test import Test
 class TFTaskBase(object):
     """Specifies common training and evaluation tasks.  """
     debug = False
+    # attributes accumulating evaluation metrics between .eval() and
+    # .post_eval(), which are swapped to evaluate multiple checkpoints
+    # in one pass
+    eval_state_attributes = []
 
     def __init__(self, session):
         super().__init__()
@@ -36,15 +41,26 @@ class TFTaskBase(object):
                 yield func(net, prediction, truth)
 
     @staticmethod
-    def _test_files(folder):
-        suffixes = ['.jpg', '.jpeg', '.png']
-        files = [
-            name for name in sorted(os.listdir(folder))
-            if any(name.endswith(s) for s in suffixes)]
-        log.debug(
-            'Running in folder {!r} on images: {}'
-            .format(folder, ', '.join(files)))
-        return [os.path.join(folder, name) for name in files]
+    def _test_files(path, recursive=False):
+        """
+        Lists images in the folder `path`, or its subfolders if `recursive`,
+        `path` can also be a glob pattern, e.g. 'inputs/**/*.jpg'.
+        """
+        suffixes = ('.jpg', '.jpeg', '.png')
+        if not os.path.isdir(path):
+            files = glob.iglob(path, recursive=True)
+        elif recursive:
+            files = (
+                os.path.join(root, name)
+                for root, _, names in os.walk(path) for name in names)
+        else:
+            files = (os.path.join(path, name) for name in os.listdir(path))
+        files = sorted(f for f in files if f.lower().endswith(suffixes))
+        if not files:
+            raise FileNotFoundError(
+                'No images found in {!r}.'.format(path))
+        log.debug('Running on {} images in {!r}.'.format(len(files), path))
+        return files
 
     def _instantiate_nets(self):
         nets = []
@@ -80,10 +96,14 @@ class TFTaskBase(object):
 
     def _register_estimates(self, prediction, truth):
         def register(root, mapping):
-            history = 'infinite' if self.mode == 'validate' else None
+            if self.mode == 'validate':
+                history, interval = 'infinite', None
+            else:
+                history, interval = None, 'format'
             if not isinstance(mapping, collections.Mapping):
                 if mapping is not None:
-                    self.estimator.register(mapping, root, history=history)
+                    self.estimator.register(
+                        mapping, root, history=history, interval=interval)
                 return
             for key, value in mapping.items():
                 register('{}.{}'.format(root, key), value)
@@ -115,7 +135,7 @@ class TFTaskBase(object):
             'Please impelement .post_eval() which computes an info dict '
             'for the evaluation metrics.')
 
-    def test(self, name, prediction):
+    def test(self, names, predictions):
         raise NotImplementedError(
-            'Please implement .test() which produces human-readable output '
-            'for a given input.')
+            'Please implement .test() which returns a list of human-readable '
+            'results for a batch of inputs.')
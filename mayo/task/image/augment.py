@@ -115,19 +115,16 @@ class Augment(object):
         return i - means
 
     def normalize_channels(self, i):
-        # FIXME we pin this augmentation action to GPU because of
-        # poor performance on CPU caused by this.
-        with tf.device('/gpu:0'):
-            i = self.subtract_channel_means(i)
-            stds = self.moment.get('std')
-            if not stds:
-                log.warn(
-                    'Channel std value not supplied, defaulting '
-                    'to 1.0 for each channel.')
-                return i
-            shape = [1, 1, len(stds)]
-            stds = tf.constant(stds, shape=shape, name='image_stds')
-            return i / stds
+        i = self.subtract_channel_means(i)
+        stds = self.moment.get('std')
+        if not stds:
+            log.warn(
+                'Channel std value not supplied, defaulting '
+                'to 1.0 for each channel.')
+            return i
+        shape = [1, 1, len(stds)]
+        stds = tf.constant(stds, shape=shape, name='image_stds')
+        return i / stds
 
     def subtract_image_mean(self, i):
         return i - tf.reduce_mean(i)
@@ -185,3 +182,58 @@ class Augment(object):
         else:
             raise ValueError('Unrecognized ensure_shape parameter.')
         return self._ensure_shape(image, fill=fill)
+
+
+class BatchAugment(Augment):
+    """
+    Augmentation actions applied to a batch of images at once, where random
+    parameters are drawn independently for each image in the batch.
+    """
+    batch_actions = [
+        'random_flip', 'linear_map', 'subtract_channel_means',
+        'normalize_channels', 'subtract_image_mean', 'standardize_image',
+        'permute_channels', 'distort_color',
+    ]
+
+    @classmethod
+    def supports(cls, action):
+        return action.get('type') in cls.batch_actions
+
+    def _random(self, i, lower, upper):
+        # a random value for each image in the batch
+        shape = [tf.shape(i)[0], 1, 1, 1]
+        return tf.random_uniform(shape, lower, upper)
+
+    def distort_color(self, i):
+        channels = i.shape[-1]
+        if channels not in (1, 3):
+            raise ValueError(
+                'Expects the number of channels of an image to be '
+                'either 1 or 3.')
+        # brightness
+        i += self._random(i, -32.0 / 255.0, 32.0 / 255.0)
+        if channels == 3:
+            hue, saturation, value = tf.unstack(
+                tf.image.rgb_to_hsv(i), axis=-1)
+            saturation *= self._random(i, 0.5, 1.5)[..., 0]
+            saturation = tf.clip_by_value(saturation, 0.0, 1.0)
+            hue = tf.mod(hue + self._random(i, -0.2, 0.2)[..., 0], 1.0)
+            i = tf.image.hsv_to_rgb(
+                tf.stack([hue, saturation, value], axis=-1))
+        # contrast
+        means = tf.reduce_mean(i, axis=[1, 2], keepdims=True)
+        i = (i - means) * self._random(i, 0.5, 1.5) + means
+        return tf.clip_by_value(i, 0.0, 1.0)
+
+    def random_flip(self, i):
+        flips = tf.random_uniform([tf.shape(i)[0]]) < 0.5
+        return tf.where(flips, tf.reverse(i, [2]), i)
+
+    def subtract_image_mean(self, i):
+        return i - tf.reduce_mean(i, axis=[1, 2, 3], keepdims=True)
+
+    def standardize_image(self, i):
+        mean, variance = tf.nn.moments(i, axes=[1, 2, 3], keep_dims=True)
+        num_elements = tf.cast(tf.reduce_prod(tf.shape(i)[1:]), tf.float32)
+        stddev = tf.maximum(tf.sqrt(variance), tf.rsqrt(num_elements))
+        return (i - mean) / stddev
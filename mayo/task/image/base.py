@@ -18,13 +18,19 @@ class ImageTaskBase(TFTaskBase):
         system = session.config.system
         mode = session.mode
         if mode == 'test':
-            files = self._test_files(system.search_path.run.inputs[0])
+            files = self._test_files(
+                system.search_path.run.inputs[0],
+                system.get('test.recursive', False))
+            num_examples = None
         else:
             files = session.config.data_files(mode)
+            num_examples = session.num_examples
         after_shape = preprocess['shape']
         self._preprocessor = Preprocess(
             system, mode, self._truth_keys, files,
-            preprocess, shape, after_shape, moment)
+            preprocess, shape, after_shape, moment, num_examples,
+            session.config.dataset.get('format', 'tfrecord'),
+            session.input_seed)
         super().__init__(session)
 
     def generate(self):
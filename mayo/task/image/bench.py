@@ -0,0 +1,76 @@
+import os
+import time
+
+import tensorflow as tf
+
+from mayo.log import log
+from mayo.util import Percent, Table
+
+
+def _measure(dataset, num_batches, warmup=5):
+    """
+    Measures the throughput of `dataset` in elements per second and the
+    CPU utilization of the process while consuming it.
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        next_element = dataset().make_one_shot_iterator().get_next()
+    with tf.Session(graph=graph) as session:
+        for _ in range(warmup):
+            session.run(next_element)
+        wall, cpu = time.time(), time.process_time()
+        for _ in range(num_batches):
+            session.run(next_element)
+        wall = time.time() - wall
+        cpu = time.process_time() - cpu
+    return num_batches / wall, cpu / (wall * os.cpu_count())
+
+
+def bench_input(
+        preprocess, num_threads_sweep, prefetch_sweep,
+        num_batches=50, stage_batch_size=256):
+    """
+    Benchmarks the input pipeline of `preprocess` for a sweep of numbers of
+    threads and prefetch sizes.  For each number of threads, each stage
+    (read, parse, decode, augment) is measured as a partial pipeline, and
+    its latency per image is the time it adds to the previous stage; the
+    full batched pipeline is then measured for each prefetch size.
+    """
+    headers = ['threads', 'prefetch', 'stage', 'imgs/s', 'us/img', 'cpu']
+    formatters = {h: None for h in headers}
+    formatters['imgs/s'] = lambda v, w: '{:{w}.0f}'.format(v, w=w or 0)
+    formatters['us/img'] = lambda v, w: '{:{w}.1f}'.format(v, w=w or 0)
+    table = Table(headers, formatters)
+    batch_size = preprocess.batch_size
+    with tf.Graph().as_default():
+        names = [name for name, _ in preprocess.stages()]
+    for num_threads in num_threads_sweep:
+        previous = 0
+        for i, name in enumerate(names):
+            def dataset(i=i):
+                stage = preprocess.stages(num_threads)[i][1]
+                # consume elements in batches to reduce session overhead
+                stage = stage.map(lambda *_: tf.constant(0))
+                return stage.batch(stage_batch_size)
+            log.info(
+                'Measuring stage {!r} with {} threads...'
+                .format(name, num_threads), update=True)
+            rate, cpu = _measure(dataset, num_batches)
+            rate *= stage_batch_size
+            latency = 1e6 / rate
+            table.add_row((
+                num_threads, None, name, rate,
+                latency - previous, Percent(cpu)))
+            previous = latency
+        for prefetch in prefetch_sweep:
+            log.info(
+                'Measuring batches with {} threads and prefetching {}...'
+                .format(num_threads, prefetch), update=True)
+            dataset = lambda: preprocess.dataset(num_threads, prefetch)
+            rate, cpu = _measure(dataset, num_batches)
+            rate *= batch_size
+            table.add_row((
+                num_threads, prefetch, 'batch', rate,
+                1e6 / rate - previous, Percent(cpu)))
+        table.add_rule()
+    return table
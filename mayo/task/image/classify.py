@@ -1,7 +1,5 @@
-import os
 import functools
 
-import yaml
 import numpy as np
 import tensorflow as tf
 from tensorflow.contrib import slim
@@ -11,8 +9,42 @@ from mayo.util import Percent, memoize_method
 from mayo.task.image.base import ImageTaskBase
 
 
+class StreamingAccuracy(object):
+    """
+    Accumulates per-example correctness batch by batch, keeping only the
+    counts and the most recent batch.
+    """
+    def __init__(self):
+        super().__init__()
+        self.reset()
+
+    def reset(self):
+        self.valids = self.total = 0
+        self.last = None
+
+    def add(self, corrects):
+        if self.last is not None:
+            self.valids += np.sum(self.last)
+            self.total += len(self.last)
+        self.last = corrects
+
+    def accuracy(self, num_remaining=None):
+        """
+        num_remaining:
+            the number of valid examples in the most recent batch, the rest
+            are wrapped around from the start of the dataset.
+        """
+        valids, total = self.valids, self.total
+        if self.last is not None:
+            last = self.last[:num_remaining or None]
+            valids += np.sum(last)
+            total += len(last)
+        return valids / total if total else 0
+
+
 class Classify(ImageTaskBase):
     _truth_keys = ['class/label']
+    eval_state_attributes = ['_accuracies']
 
     def transform(self, net, data, prediction, truth):
         truth = truth[0] + self.label_offset
@@ -70,28 +102,30 @@ class Classify(ImageTaskBase):
 
     def eval(self):
         def metrics(net, prediction, truth):
-            top1 = self._top(prediction, truth, 1)
-            top5 = self._top(prediction, truth, 5)
+            # reduce one-hot weights to per-example correctness on device
+            top1 = tf.reduce_sum(self._top(prediction, truth, 1), axis=-1)
+            top5 = tf.reduce_sum(self._top(prediction, truth, 5), axis=-1)
             return top1, top5
 
         top1s, top5s = zip(*self.map(metrics))
         top1s = tf.concat(top1s, axis=0)
         top5s = tf.concat(top5s, axis=0)
 
-        self._formatted_history = {}
+        self._accuracies = {}
+
+        def transformer(value, name):
+            self._accuracies[name].add(value)
+            return value
 
         def formatter(estimator, name):
-            history = self._formatted_history.setdefault(name, [])
-            value = estimator.get_value(name, 'eval')
-            value = np.sum(value, axis=-1)
-            history.append(sum(value))
-            accuracy = Percent(
-                sum(history) / (self.session.batch_size * len(history)))
+            accuracy = Percent(self._accuracies[name].accuracy())
             return '{}: {}'.format(name, accuracy)
 
         for tensor, name in ((top1s, 'top1'), (top5s, 'top5')):
+            self._accuracies[name] = StreamingAccuracy()
             self.estimator.register(
-                tensor, name, 'eval', history='infinite',
+                tensor, name, 'eval', history=1,
+                transformer=functools.partial(transformer, name=name),
                 formatter=functools.partial(formatter, name=name))
 
     def post_eval(self):
@@ -99,30 +133,24 @@ class Classify(ImageTaskBase):
         num_examples = self.session.num_examples
         num_remaining = num_examples % self.session.batch_size
         for key in ('top1', 'top5'):
-            history = self.estimator.get_history(key, 'eval')
-            history[-1] = history[-1][:num_remaining]
-            valids = total = 0
-            for h in history:
-                valids += np.sum(h)
-                total += len(h)
-            stats[key] = Percent(valids / total)
+            accuracy = self._accuracies[key]
+            stats[key] = Percent(accuracy.accuracy(num_remaining))
+            accuracy.reset()
             self.estimator.flush(key, 'eval')
-            self.estimator.add(stats, 'accuracy', 'eval')
-            self._formatted_history = {}
+        self.estimator.add(stats, 'accuracy', 'eval')
         log.info(
             '    top1: {}, top5: {} [{} images]'
             .format(stats['top1'], stats['top5'], num_examples))
         return stats
 
-    def test(self, names, inputs, predictions):
-        results = {}
-        for name, image, prediction in zip(names, inputs, predictions):
+    def test(self, names, predictions):
+        results = []
+        for name, prediction in zip(names, predictions):
+            if not name:
+                # padded images of the final batch
+                continue
             name = name.decode()
             label = self.class_names[np.argmax(prediction)]
-            log.info('{} labeled as {}.'.format(name, label))
-            results[name] = label
-        output_dir = self.config.system.search_path.run.outputs[0]
-        os.makedirs(output_dir, exist_ok=True)
-        filename = os.path.join(output_dir, 'predictions.yaml')
-        with open(filename, 'w') as f:
-            yaml.dump(results, f)
+            log.debug('{} labeled as {}.'.format(name, label))
+            results.append({'name': name, 'label': label})
+        return results
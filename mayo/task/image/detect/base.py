@@ -1,6 +1,10 @@
+import functools
+import threading
+
 import numpy as np
 import tensorflow as tf
 
+from mayo.log import log
 from mayo.util import Percent
 from mayo.task.image.base import ImageTaskBase
 from mayo.task.image.detect import util
@@ -10,107 +14,100 @@ class ImageDetectTaskBase(ImageTaskBase):
     """
     This base class implements mAP evaluation for all detection algorithms.
     """
-    def _mean_avg_precisions(
-            self, pred_box, pred_class, pred_score, pred_count,
-            truth_box, truth_class, truth_count):
-        num_imgs, num_classes = self.batch_size, self.num_classes
-        detections = [[None for i in range(num_classes)] for j in
-                      range(num_imgs)]
-        annotations = [[None for i in range(num_classes)] for j in
-                       range(num_imgs)]
+    eval_iou_threshold = 0.5
+    eval_state_attributes = ['_detections', '_num_truths', '_num_images']
+
+    def _reset_detections(self):
+        self._detections = {'score': [], 'class': [], 'true_pos': []}
+        self._num_truths = np.zeros(self.num_classes, dtype=np.int64)
+        # the number of images evaluated by each GPU
+        self._num_images = [0] * self.session.num_gpus
+
+    def _valid_images(self, gpu, num_images):
+        """
+        The number of images in a batch of GPU #`gpu` which are not
+        wrapped around from the start of the dataset.
+        """
+        batch_size_per_gpu = self.config.system.batch_size_per_gpu
+        step = self._num_images[gpu] // batch_size_per_gpu
+        self._num_images[gpu] += num_images
+        start = step * self.session.batch_size + gpu * batch_size_per_gpu
+        return min(max(self.session.num_examples - start, 0), num_images)
 
-        for i in range(num_imgs):
-            pred_box_i = pred_box[i, :]
-            pred_score_i = np.array([pred_score[i, :]])
-            truth_box_i = truth_box[i, :]
-            pred_class_i = pred_class[i, :]
-            for label in range(num_classes):
-                index = pred_class_i == label
-                if pred_count[i] == 0 or (not any(index)):
-                    detections[i][label] = []
-                else:
-                    detections[i][label] = np.concatenate(
-                        (pred_box_i[index[:], :],
-                         pred_score_i[:, index[:]].T), axis=1)
-                index = truth_class[i, :] == label
-                if truth_count[i] == 0 or (not any(index)):
-                    annotations[i][label] = []
-                else:
-                    annotations[i][label] = truth_box_i[index, :]
-        # compute mean_aps
-        avg_precisions = np.zeros((num_classes, 1))
-        for label in range(num_classes):
-            false_pos = true_pos = scores = np.zeros((0,))
-            num_annotations = 0.0
-            for i in range(num_imgs):
-                ds = detections[i][label]
-                ans = annotations[i][label]
-                num_annotations += ans.shape[0] if ans != [] else 0
-                detected_ans = []
-                for d in ds:
-                    scores = np.append(scores, d[4])
-                    if ans == [] or ans.shape[0] == 0:
-                        false_pos = np.append(false_pos, 1)
-                        true_pos = np.append(true_pos, 0)
-                        continue
-                    overlaps, iw, ih, intersection, ou = util.np_iou(
-                        np.expand_dims(d[:4], axis=0), ans)
-                    tmp = np.expand_dims(d[:4], axis=0)
-                    assigned_ans = np.argmax(overlaps, axis=1)
-                    max_overlap = overlaps[0, assigned_ans]
-                    if max_overlap >= self.iou_threshold \
-                            and assigned_ans not in detected_ans:
-                        false_pos = np.append(false_pos, 0)
-                        true_pos = np.append(true_pos, 1)
-                        detected_ans.append(assigned_ans)
-                    else:
-                        false_pos = np.append(false_pos, 1)
-                        true_pos = np.append(true_pos, 0)
-            if num_annotations == 0:
-                avg_precisions[label] = 0
-                continue
+    def _add_detections(
+            self, corners, classes, scores, counts,
+            truth_corners, truth_classes, truth_counts, gpu=0):
+        """
+        Match detections in a batch and accumulate them for evaluation.
+        """
+        with self._detections_lock:
+            num_valids = self._valid_images(gpu, len(counts))
+        # images wrapped around in the final batch are not evaluated again
+        counts = counts[:num_valids]
+        truth_counts = truth_counts[:num_valids]
+        matches = [np.zeros(0, dtype=bool)]
+        for i, (count, truth_count) in enumerate(zip(counts, truth_counts)):
+            matches.append(util.np_match_detections(
+                corners[i, :count], classes[i, :count], scores[i, :count],
+                truth_corners[i, :truth_count],
+                truth_classes[i, :truth_count], self.eval_iou_threshold))
+        scores, classes = scores[:num_valids], classes[:num_valids]
+        truth_classes = truth_classes[:num_valids]
+        valids = np.arange(scores.shape[1]) < counts[:, None]
+        truth_valids = \
+            np.arange(truth_classes.shape[1]) < truth_counts[:, None]
+        num_truths = np.bincount(
+            truth_classes[truth_valids], minlength=self.num_classes)
+        with self._detections_lock:
+            self._detections['score'].append(scores[valids])
+            self._detections['class'].append(classes[valids])
+            self._detections['true_pos'].append(np.concatenate(matches))
+            self._num_truths += num_truths[:self.num_classes]
+        return np.int32(np.sum(counts))
 
-            # sort by score
-            indices = np.argsort(-scores)
-            false_pos = false_pos[indices[:]]
-            true_pos = true_pos[indices[:]]
+    def _mean_avg_precision(self):
+        with self._detections_lock:
+            detections = {
+                k: np.concatenate(v) if v else np.zeros(0)
+                for k, v in self._detections.items()}
+            num_truths = self._num_truths.copy()
+        avg_precisions = util.np_average_precisions(
+            detections['score'], detections['class'].astype(np.int64),
+            detections['true_pos'].astype(bool), num_truths)
+        if not avg_precisions.size:
+            return 0
+        return np.mean(avg_precisions)
 
-            # compute false positives and true positives
-            false_pos = np.cumsum(false_pos)
-            true_pos = np.cumsum(true_pos)
+    def eval(self):
+        self._detections_lock = threading.Lock()
+        self._reset_detections()
 
-            # compute recall and precision
-            recall = true_pos / num_annotations
-            precision = true_pos / np.maximum(
-                true_pos + false_pos, np.finfo(np.float64).eps)
+        gpus = iter(range(self.session.num_gpus))
 
-            # compute average precision
-            ap = util.np_average_precision(recall, precision)
-            avg_precisions[label] = ap
-        return avg_precisions.astype(np.float32)
+        def metrics(net, prediction, truth):
+            add_detections = functools.partial(
+                self._add_detections, gpu=next(gpus))
+            inputs = [
+                prediction['test']['corner'],
+                prediction['test']['class'],
+                prediction['test']['score'],
+                prediction['test']['count'],
+                util.box_to_corners(truth['rawbox']),
+                truth['rawclass'],
+                truth['count'],
+            ]
+            return tf.py_func(add_detections, inputs, tf.int32)
 
-    def eval(self, net, prediction, truth):
-        """
-            detections: the prediciton of object class
-            annotations: positions of the objects
-        """
-        # forced dummy test
-        # fakes = []
-        # for item in mean_aps_inputs:
-        #     fakes.append(np.random.randint(10, size=item.shape))
-        # dummy = self._mean_avg_precisions(*fakes)
-        inputs = [
-            prediction['test']['box'],
-            prediction['test']['class'],
-            prediction['test']['score'],
-            prediction['test']['count'],
-            truth['rawbox'],
-            truth['rawclass'],
-            truth['count'],
-        ]
-        tensor = tf.py_func(self._mean_avg_precisions, inputs, tf.float32)
-        tensor = tf.reduce_sum(tensor)
-        tensor /= tf.cast(tf.size(tensor), tf.float32)
-        formatter = lambda e: 'mAP accuracy: {}'.format(
-            Percent(e.get_mean('accuracy')))
-        self.estimator.register(tensor, 'accuracy', formatter=formatter)
+        # mAP is only computed in `post_eval`, as it goes over all
+        # accumulated detections
+        num_detections = tf.stack(list(self.map(metrics)))
+        self.estimator.register(num_detections, 'detections', history=1)
+
+    def post_eval(self):
+        stats = {'mAP': Percent(self._mean_avg_precision())}
+        self._reset_detections()
+        self.estimator.add(stats, 'accuracy', 'eval')
+        log.info(
+            '    mAP: {} [{} images]'
+            .format(stats['mAP'], self.session.num_examples))
+        return stats
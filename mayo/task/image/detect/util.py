@@ -156,8 +156,7 @@ def np_average_precision(recall, precision):
     mpre = np.concatenate(([0.], precision, [0.]))
 
     # compute the precision envelope
-    for i in range(mpre.size - 1, 0, -1):
-        mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
+    mpre = np.maximum.accumulate(mpre[::-1])[::-1]
 
     # to calculate area under PR curve, look for points
     # where X axis (recall) changes value
@@ -165,3 +164,75 @@ def np_average_precision(recall, precision):
 
     # and sum (\Delta recall) * prec
     return np.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])
+
+
+def np_iou_matrix(corners1, corners2):
+    """
+    Compute pair-wise IOU values between two sets of boxes.
+
+    corners1, corners2:
+        (N, 4) and (K, 4) numpy arrays of corner vertices
+        (y_min, x_min, y_max, x_max).
+    returns: a (N, K) ndarray of IOU values.
+    """
+    y1_min, x1_min, y1_max, x1_max = np.split(corners1, 4, axis=1)
+    y2_min, x2_min, y2_max, x2_max = corners2.T
+    ih = np.minimum(y1_max, y2_max) - np.maximum(y1_min, y2_min)
+    iw = np.minimum(x1_max, x2_max) - np.maximum(x1_min, x2_min)
+    intersection = np.maximum(ih, 0) * np.maximum(iw, 0)
+    area1 = (y1_max - y1_min) * (x1_max - x1_min)
+    area2 = (y2_max - y2_min) * (x2_max - x2_min)
+    union = np.maximum(area1 + area2 - intersection, np.finfo(float).eps)
+    return intersection / union
+
+
+def np_match_detections(
+        corners, classes, scores, truth_corners, truth_classes,
+        iou_threshold):
+    """
+    Match detections of an image to its truth boxes.
+
+    In descending score order, each detection is assigned to the truth box
+    of the same class it overlaps the most, and it is a true positive if the
+    IOU reaches `iou_threshold` and no earlier detection claimed the box.
+
+    returns: a boolean array of true positives for the given detections.
+    """
+    true_pos = np.zeros(len(scores), dtype=bool)
+    if not len(scores) or not len(truth_classes):
+        return true_pos
+    order = np.argsort(-scores, kind='mergesort')
+    overlaps = np_iou_matrix(corners[order], truth_corners)
+    overlaps[classes[order, None] != truth_classes[None, :]] = -1
+    assigned = np.argmax(overlaps, axis=1)
+    max_overlaps = overlaps[np.arange(len(order)), assigned]
+    matches = np.flatnonzero(max_overlaps >= iou_threshold)
+    # only the first detection of each truth box counts
+    _, first = np.unique(assigned[matches], return_index=True)
+    true_pos[order[matches[first]]] = True
+    return true_pos
+
+
+def np_average_precisions(scores, classes, true_pos, num_truths):
+    """
+    Compute the average precision of each class from accumulated matches.
+
+    scores, classes, true_pos: the score, class and match of detections.
+    num_truths: the number of truth boxes of each class.
+    returns:
+        an array of average precisions for classes with truth boxes.
+    """
+    order = np.argsort(-scores, kind='mergesort')
+    classes, true_pos = classes[order], true_pos[order]
+    avg_precisions = []
+    for label, num in enumerate(num_truths):
+        if num == 0:
+            continue
+        label_true_pos = true_pos[classes == label]
+        true_pos_sum = np.cumsum(label_true_pos)
+        false_pos_sum = np.cumsum(~label_true_pos)
+        recall = true_pos_sum / num
+        precision = true_pos_sum / np.maximum(
+            true_pos_sum + false_pos_sum, np.finfo(np.float64).eps)
+        avg_precisions.append(np_average_precision(recall, precision))
+    return np.array(avg_precisions)
@@ -32,7 +32,7 @@ class YOLOv2(ImageDetectTaskBase):
             self, session, preprocess, num_classes, background_class,
             shape, anchors, scales, moment=None, num_cells=13,
             train_iou_threshold=0.6, score_threshold=0.3,
-            nms_iou_threshold=0.5, nms_max_boxes=10):
+            nms_iou_threshold=0.5, nms_max_boxes=10, eval_iou_threshold=0.5):
         """
         anchors (tensor):
             a (num_anchors x 2) tensor of anchor boxes [(h, w), ...].
@@ -46,6 +46,9 @@ class YOLOv2(ImageDetectTaskBase):
             during validation.
         nms_iou_threshold (float):
             the IOU threshold used by non-max suppression during validation.
+        eval_iou_threshold (float):
+            the IOU threshold for a detection to match a truth box in mAP
+            evaluation.
         """
         self.batch_size = session.batch_size
         self._anchors = anchors
@@ -68,6 +71,7 @@ class YOLOv2(ImageDetectTaskBase):
         self.score_threshold = score_threshold
         self.nms_iou_threshold = nms_iou_threshold
         self.nms_max_boxes = nms_max_boxes
+        self.eval_iou_threshold = eval_iou_threshold
 
         super().__init__(
             session, preprocess, num_classes, background_class, shape, moment)
@@ -289,6 +293,7 @@ class YOLOv2(ImageDetectTaskBase):
         corners = corners[:count]
         iterer = list(zip(corners, scores, classes))
         iterer = reversed(sorted(iterer, key=lambda v: v[1]))
+        detections = []
         for corner, score, cls in iterer:
             layer = Image.new('RGBA', image.size, (255, 255, 255, 0))
             draw = ImageDraw.ImageDraw(layer)
@@ -315,6 +320,8 @@ class YOLOv2(ImageDetectTaskBase):
             log.info(
                 '  Confidence: {:f}, class: {}, box: ({}, {}) ({}, {})'
                 .format(score, cls_name, *box))
+            detections.append(
+                {'class': cls_name, 'score': float(score), 'box': box})
         path = self.session.config.system.search_path.run.outputs[0]
         path = os.path.join(path, 'detect')
         os.makedirs(path, exist_ok=True)
@@ -322,13 +329,20 @@ class YOLOv2(ImageDetectTaskBase):
         name, ext = os.path.splitext(name)
         path = os.path.join(path, '{}.png'.format(name))
         image.save(path, quality=90)
+        return detections
 
     def test(self, names, predictions):
         test = predictions['test']
         iterer = zip(
             names, test['corner'], test['score'], test['class'], test['count'])
-        for args in iterer:
-            self._test(*args)
+        results = []
+        for name, *args in iterer:
+            if not name:
+                # padded images of the final batch
+                continue
+            detections = self._test(name, *args)
+            results.append({'name': name.decode(), 'detections': detections})
+        return results
 
     def _iou_score(self, pred_box, truth_box, num_objects):
         shape = [
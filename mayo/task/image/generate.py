@@ -1,13 +1,22 @@
+import os
+import zlib
+
+import numpy as np
 import tensorflow as tf
 
+from mayo.log import log
 from mayo.util import ensure_list, pad_to_shape
-from mayo.task.image.augment import Augment
+from mayo.task.image.augment import Augment, BatchAugment
+from mayo.task.image.packed import PackedDataset
+from mayo.session.base import SessionBase
+from mayo.session.checkpoint import CheckpointHandler
 
 
 class Preprocess(object):
     def __init__(
             self, system, mode, truth_keys, files, actions,
-            before_shape, after_shape, moment=None):
+            before_shape, after_shape, moment=None, num_examples=None,
+            format='tfrecord', seed=None):
         super().__init__()
         self.system = system
         self.mode = mode
@@ -22,6 +31,12 @@ class Preprocess(object):
         self.before_shape = shape_to_tuple(before_shape)
         self.after_shape = shape_to_tuple(after_shape)
         self.moment = moment
+        self.num_examples = num_examples
+        if format not in ['tfrecord', 'packed']:
+            raise ValueError(
+                'Unrecognized dataset format {!r}.'.format(format))
+        self.format = format
+        self.seed = seed
 
     @staticmethod
     def _decode_jpeg(buffer, channels):
@@ -74,6 +89,101 @@ class Preprocess(object):
     def _actions(self, key):
         return ensure_list(self.actions.get(key) or [])
 
+    # deterministic actions which keep values in [0, 1], so that their
+    # results can be cached as uint8 images
+    _cacheable_actions = ('central_crop', 'crop_or_pad', 'resize')
+
+    def _cached_actions(self):
+        """
+        The leading validation actions that can be applied before caching.
+        """
+        if self.mode != 'validate':
+            return []
+        actions = self._actions(self.mode)
+        index = 0
+        while index < len(actions) and \
+                actions[index].get('type') in self._cacheable_actions:
+            index += 1
+        return actions[:index]
+
+    def _record_actions(self):
+        """
+        Splits actions for records into those applied to each image before
+        caching, those applied to each image after caching, and the trailing
+        ones that can be applied to batches of images with BatchAugment.
+        """
+        actions = self._actions(self.mode) + self._actions('final_cpu')
+        cached = []
+        if self._cache_path() is not None:
+            cached = self._cached_actions()
+            actions = actions[len(cached):]
+        if not self.system.preprocess.get('batch_augment', False):
+            return cached, actions, []
+        index = len(actions)
+        while index > 0 and BatchAugment.supports(actions[index - 1]):
+            index -= 1
+        return cached, actions[:index], actions[index:]
+
+    def _cache_path(self):
+        """
+        Returns the file name to cache decoded images in, an empty string
+        for caching in memory, or None if caching is disabled.
+        """
+        cache = self.system.preprocess.get('cache', {})
+        if self.mode not in (cache.get('modes') or []):
+            return None
+        if self.format == 'packed':
+            # packed images are already decoded and memory-mapped
+            return None
+        # decoded images are cached before training actions, and after
+        # validation crops and resizes, which are bounded by the larger of
+        # the shapes before and after them
+        shape = self.before_shape
+        if self._cached_actions():
+            shape = tuple(
+                None if None in dims else max(dims)
+                for dims in zip(self.before_shape, self.after_shape))
+        path = cache.get('path')
+        if None in shape:
+            # the size of images to cache is unknown, so we cannot budget
+            # them in memory
+            if not path:
+                log.warn(
+                    'Decoded images of {!r} mode have unknown sizes, not '
+                    'caching as no cache path is specified.'
+                    .format(self.mode), once='preprocess_cache')
+                return None
+            log.warn(
+                'Decoded images of {!r} mode have unknown sizes, caching '
+                'them in {!r}.'.format(self.mode, path),
+                once='preprocess_cache')
+            return self._cache_file(path)
+        height, width, channels = shape
+        num_bytes = (self.num_examples or 0) * height * width * channels
+        max_memory = cache.get('max_memory', 4096) * 1024 * 1024
+        if num_bytes <= max_memory:
+            return ''
+        if not path:
+            log.warn(
+                'Decoded images of {!r} mode need about {:.0f} MiB, which '
+                'exceeds the cache memory budget, not caching as no cache '
+                'path is specified.'.format(self.mode, num_bytes / 2 ** 20),
+                once='preprocess_cache')
+            return None
+        return self._cache_file(path)
+
+    def _cache_file(self, path):
+        os.makedirs(path, exist_ok=True)
+        shard = self.system.preprocess.get('reader.shard.index', 0)
+        # cached images are only reused for the same files, cached actions
+        # and shapes
+        actions = [sorted(dict(a).items()) for a in self._cached_actions()]
+        key = sorted(self._files()) + [
+            repr(actions), repr(self.before_shape), repr(self.after_shape)]
+        key = zlib.crc32('\n'.join(key).encode('utf-8'))
+        name = '{}-{}-{:08x}'.format(self.mode, shard, key)
+        return os.path.join(path, name)
+
     def _preprocess_images(self, name):
         image_string = tf.read_file(name)
         image = tf.image.decode_jpeg(
@@ -82,17 +192,31 @@ class Preprocess(object):
         image = self.augment(image, ensure_shape='stretch')
         return image, name
 
-    def _preprocess_records(self, serialized):
-        # unserialize and prepocess image
+    def _decode_records(self, serialized):
+        # unserialize and decode jpeg image
         buffer, label, bbox, count, bbox_label, text = \
             self._parse_proto(serialized)
-        # decode jpeg image
         channels = self.before_shape[-1]
         image = self._decode_jpeg(buffer, channels)
+        return image, label, bbox, count, bbox_label, text
+
+    def _cache_records(self, image, label, bbox, count, *others):
+        cached_actions, _, _ = self._record_actions()
+        if cached_actions:
+            augment_bbox = tf.expand_dims(bbox[:count], 0)
+            augment = Augment(
+                image, augment_bbox, self.after_shape, self.moment)
+            image = augment.augment(cached_actions, ensure_shape=False)
+        # store images compactly as uint8
+        image = tf.image.convert_image_dtype(image, tf.uint8, saturate=True)
+        return (image, label, bbox, count) + others
+
+    def _augment_records(self, image, label, bbox, count, bbox_label, text):
+        image = tf.image.convert_image_dtype(image, dtype=tf.float32)
         # augment image
         augment_bbox = tf.expand_dims(bbox[:count], 0)
         augment = Augment(image, augment_bbox, self.after_shape, self.moment)
-        actions = self._actions(self.mode) + self._actions('final_cpu')
+        _, actions, _ = self._record_actions()
         image = augment.augment(actions)
         values = [image]
         truth_map = {
@@ -106,6 +230,27 @@ class Preprocess(object):
             values.append(truth_map[key])
         return values
 
+    def _preprocess_records(self, serialized):
+        return self._augment_records(*self._decode_records(serialized))
+
+    def _augment_batch(self, images, *truths):
+        _, _, actions = self._record_actions()
+        augment = BatchAugment(images, None, self.after_shape, self.moment)
+        return [augment.augment(actions, ensure_shape=False)] + list(truths)
+
+    def _pad_batch(self, images, names):
+        # pad a batch of test images to the full batch size, padded images
+        # have empty names
+        batch_size = self.batch_size
+        image_shape = images.shape.as_list()[1:]
+        padding = batch_size - tf.shape(images)[0]
+        shape = tf.concat([[padding], tf.shape(images)[1:]], axis=0)
+        images = tf.concat([images, tf.zeros(shape, images.dtype)], axis=0)
+        names = tf.concat([names, tf.fill([padding], '')], axis=0)
+        images.set_shape([batch_size] + image_shape)
+        names.set_shape([batch_size])
+        return images, names
+
     def augment(self, image, ensure_shape='fill'):
         # augment for validation
         augment = Augment(image, None, self.after_shape, self.moment)
@@ -113,46 +258,231 @@ class Preprocess(object):
         actions += self._actions(self._actions('final_gpu'))
         return augment.augment(actions, ensure_shape=ensure_shape)
 
-    def preprocess(self):
-        # file names
-        num_gpus = self.system.num_gpus
-        batch_size = self.system.batch_size_per_gpu * num_gpus
-        dataset = tf.data.Dataset.from_tensor_slices(self.files)
-        if self.mode == 'train':
-            # shuffle .tfrecord files
-            dataset = dataset.shuffle(buffer_size=len(self.files))
+    def _shard(self):
+        reader = self.system.preprocess.get('reader', {})
+        count = reader.get('shard.count', 1)
+        index = reader.get('shard.index', 0)
+        if not 0 <= index < count:
+            raise ValueError(
+                'Shard index {!r} out of range for {!r} shards.'
+                .format(index, count))
+        return index, count
+
+    def _sharded_files(self):
+        index, count = self._shard()
+        # sort to ensure workers agree on disjoint shards
+        files = sorted(self.files)[index::count]
+        if not files:
+            raise ValueError(
+                'No files left in shard {!r} of {!r} shards.'
+                .format(index, count))
+        return files
+
+    def _read_records(self, dataset):
+        """
+        Reads records by interleaving multiple files in parallel.
+        """
+        reader = self.system.preprocess.get('reader', {})
+        buffer_size = reader.get('buffer_size', None)
+        read = lambda f: tf.data.TFRecordDataset(f, buffer_size=buffer_size)
+        return dataset.apply(tf.contrib.data.parallel_interleave(
+            read, cycle_length=reader.get('cycle_length', 8),
+            block_length=reader.get('block_length', 1),
+            sloppy=reader.get('sloppy', False)))
+
+    def _read_packed(self, files, seed=None):
+        """
+        Reads decoded images from packed datasets in `files`.
+        """
+        index, count = self._shard()
+        # examples of all directories are shuffled and repeated together,
+        # as each repeated dataset never ends
+        packed = PackedDataset(sorted(files))
+        # shard examples instead of files
+        indices = np.arange(packed.num_examples)[index::count]
+        return packed.dataset(
+            indices, shuffle=self.mode == 'train', seed=seed)
+
+    @property
+    def batch_size(self):
+        return self.system.batch_size_per_gpu * self.system.num_gpus
+
+    def _files(self):
+        if self.mode == 'test' or self.format == 'packed':
+            return self.files
+        return self._sharded_files()
+
+    def stages(self, num_threads=None):
+        """
+        Partial pipelines of records ending at each preprocessing stage,
+        used for benchmarking.  Returns an ordered list of (stage name,
+        dataset of examples) pairs.
+        """
+        if self.mode == 'test':
+            raise ValueError('Stages are not available in test mode.')
+        num_threads = self._autotune(
+            num_threads or self.system.preprocess.num_threads)
+        files = self._files()
+        if self.format == 'packed':
+            read = self._read_packed(files)
+            stages = [('read', read)]
+        else:
+            read = tf.data.Dataset.from_tensor_slices(files)
+            read = self._read_records(read).repeat()
+            parse = read.map(
+                self._parse_proto, num_parallel_calls=num_threads)
+            decode = read.map(
+                self._decode_records, num_parallel_calls=num_threads)
+            stages = [('read', read), ('parse', parse), ('decode', decode)]
+        augment = stages[-1][1].map(
+            self._augment_records, num_parallel_calls=num_threads)
+        stages.append(('augment', augment))
+        return stages
+
+    @staticmethod
+    def _autotune(value):
+        if value == 'auto':
+            return tf.data.experimental.AUTOTUNE
+        return value
+
+    def _shuffle_buffer_size(self):
+        batch_size = self.batch_size
+        buffer_size = min(1024, 10 * batch_size)
+        max_memory = self.system.preprocess.get('shuffle_memory')
+        if max_memory is None:
+            return buffer_size
+        # cap the memory footprint of buffered float32 images
+        height, width, channels = self.after_shape
+        image_size = height * width * channels * 4
+        max_size = max(max_memory * 1024 * 1024 // image_size, batch_size)
+        return min(buffer_size, max_size)
+
+    def dataset(self, num_threads=None, prefetch=None, seed=None):
+        """
+        The dataset of preprocessed batches.
+
+        num_threads:
+            the number of parallel calls of maps, or 'auto' to tune it by
+            measured stall time, defaults to `system.preprocess.num_threads`.
+        prefetch:
+            the number of batches to prefetch, or 'auto' to tune it,
+            defaults to `system.preprocess.prefetch`.
+        seed:
+            the seed of shuffling, which can be a tensor.
+        """
+        batch_size = self.batch_size
+        num_threads = self._autotune(
+            num_threads or self.system.preprocess.num_threads)
+        if prefetch is None:
+            prefetch = self.system.preprocess.get('prefetch', 2)
+        prefetch = self._autotune(prefetch)
+        files = self._files()
+        dataset = tf.data.Dataset.from_tensor_slices(files)
 
         if self.mode == 'test':
             func = self._preprocess_images
+        elif self.format == 'packed':
+            dataset = self._read_packed(files, seed)
+            func = self._augment_records
         else:
+            cache_path = self._cache_path()
+            if self.mode == 'train':
+                # shuffle .tfrecord files
+                dataset = dataset.shuffle(
+                    buffer_size=len(files), seed=seed)
+            # repeating the file list lets interleaving continue across
+            # epochs, but with fewer files than the cycle length, a file
+            # would be read by multiple cycles at once, duplicating records
+            cycle_length = self.system.preprocess.get(
+                'reader.cycle_length', 8)
+            overlap = self.mode == 'train' and cache_path is None and \
+                len(files) >= cycle_length
+            if overlap:
+                dataset = dataset.repeat()
             # tfrecord files to images
-            dataset = dataset.flat_map(tf.data.TFRecordDataset)
-            dataset = dataset.repeat()
-            func = self._preprocess_records
-
-        num_threads = self.system.preprocess.num_threads
+            dataset = self._read_records(dataset)
+            if cache_path is None:
+                if not overlap:
+                    # repeat whole passes of records
+                    dataset = dataset.repeat()
+                func = self._preprocess_records
+            else:
+                # decode once, and cache decoded images for all epochs
+                dataset = dataset.map(
+                    lambda r: self._cache_records(*self._decode_records(r)),
+                    num_parallel_calls=num_threads)
+                dataset = dataset.cache(cache_path).repeat()
+                func = self._augment_records
         dataset = dataset.map(func, num_parallel_calls=num_threads)
-        if self.mode in ['train', 'validate']:
-            dataset = dataset.prefetch(num_threads * batch_size)
-            if self.mode == 'train':
-                buffer_size = min(1024, 10 * batch_size)
-                dataset = dataset.shuffle(buffer_size=buffer_size)
-        dataset = dataset.batch(batch_size, drop_remainder=True)
-        # iterator
-        iterator = dataset.make_one_shot_iterator()
+        if self.mode == 'train':
+            dataset = dataset.shuffle(
+                buffer_size=self._shuffle_buffer_size(), seed=seed)
+        if self.mode == 'test':
+            # keep the final batch of test images
+            dataset = dataset.batch(batch_size).map(self._pad_batch)
+        else:
+            dataset = dataset.batch(batch_size, drop_remainder=True)
+            if self._record_actions()[2]:
+                dataset = dataset.map(
+                    self._augment_batch, num_parallel_calls=num_threads)
+        # prefetch batches rather than individual images
+        return dataset.prefetch(prefetch)
+
+    def _resumable(self):
+        if self.mode != 'train' or self.format != 'tfrecord':
+            # packed datasets are read with `tf.py_func`, which cannot be
+            # serialized
+            return False
+        if not self.system.preprocess.get('resume', False):
+            return False
+        if self._cache_path() == '':
+            # the saved position would include all cached images
+            log.warn(
+                'Not saving the position of the input pipeline, as decoded '
+                'images are cached in memory.', once='preprocess_resume')
+            return False
+        return True
+
+    def _iterator_scope(self):
+        # the scope names the saved iterator position, so that it is only
+        # restored for the same mode, files and batch size
+        key = '\n'.join(sorted(self._files()) + [str(self.batch_size)])
+        key = zlib.crc32(key.encode('utf-8'))
+        return 'input_{}_{:08x}'.format(self.mode, key)
+
+    def preprocess(self):
+        num_gpus = self.system.num_gpus
+        dataset = self.dataset(seed=self.seed)
+        # iterator, which is initialized by the session after checkpoint
+        # loading, as it captures the seed variable
+        with tf.name_scope(self._iterator_scope()):
+            iterator = dataset.make_initializable_iterator()
+        tf.add_to_collection(SessionBase.iterators_collection, iterator)
+        if self._resumable():
+            # save its position in checkpoints
+            tf.add_to_collection(
+                CheckpointHandler.iterators_collection, iterator)
         batch = iterator.get_next()
+        # the batch tensors before splitting, which can be fed
+        self.batch = batch
         batch_splits = list(zip(
             *(tf.split(each, num_gpus, axis=0) for each in batch)))
 
         # final preprocessing on gpu
         gpu_actions = self._actions('final_gpu')
+        unsupported = [
+            a.get('type') for a in gpu_actions
+            if not BatchAugment.supports(a)]
+        if unsupported:
+            raise ValueError(
+                'Augmentation actions {!r} in final_gpu cannot be applied to '
+                'batches of images.'.format(unsupported))
         if gpu_actions:
-            def augment(i):
-                augment = Augment(i, None, self.after_shape, self.moment)
-                return augment.augment(gpu_actions, ensure_shape=False)
             for gid, (images, *additional) in enumerate(batch_splits):
+                # soft placement falls back to CPU if no GPUs are available
                 with tf.device('/gpu:{}'.format(gid)):
-                    # FIXME is tf.map_fn good for performance?
-                    images = tf.map_fn(augment, images)
+                    augment = BatchAugment(
+                        images, None, self.after_shape, self.moment)
+                    images = augment.augment(gpu_actions, ensure_shape=False)
                 batch_splits[gid] = [images] + additional
         return batch_splits
@@ -0,0 +1,146 @@
+import os
+import collections
+
+import numpy as np
+import tensorflow as tf
+
+from mayo.log import log
+from mayo.util import ensure_list
+
+
+class PackedDataset(object):
+    """
+    A dataset of fixed-shape uint8 images and their truths, packed as
+    memory-mapped numpy arrays in the directory `path`, or concatenated
+    from a list of such directories:
+
+        images.npy: (N, height, width, channels) uint8 images.
+        labels.npy: (N, ) int32 class labels.
+        bboxes.npy: (N, max_objects, 4) float32 bounding boxes.
+        bbox_labels.npy: (N, max_objects) int32 bounding box labels.
+        bbox_counts.npy: (N, ) int32 numbers of bounding boxes.
+    """
+    columns = collections.OrderedDict([
+        ('images', np.uint8),
+        ('labels', np.int32),
+        ('bboxes', np.float32),
+        ('bbox_labels', np.int32),
+        ('bbox_counts', np.int32),
+    ])
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        # the arrays of each directory
+        self.arrays = []
+        for each in ensure_list(path):
+            arrays = collections.OrderedDict()
+            for name in self.columns:
+                file = os.path.join(each, '{}.npy'.format(name))
+                arrays[name] = np.load(file, mmap_mode='r')
+            self.arrays.append(arrays)
+        for arrays in self.arrays[1:]:
+            for name, array in arrays.items():
+                shape = self.arrays[0][name].shape[1:]
+                if array.shape[1:] != shape:
+                    raise ValueError(
+                        'Packed {} of shape {} do not match the shape {} of '
+                        'the first directory.'
+                        .format(name, array.shape[1:], shape))
+        sizes = [len(arrays['images']) for arrays in self.arrays]
+        # the first index of each directory
+        self._offsets = np.cumsum([0] + sizes)
+        self.num_examples = int(self._offsets[-1])
+
+    def _gather(self, indices):
+        # directories of `indices`
+        parts = np.searchsorted(self._offsets, indices, side='right') - 1
+        values = [
+            np.empty((len(indices), ) + a.shape[1:], dtype=a.dtype)
+            for a in self.arrays[0].values()]
+        for part, arrays in enumerate(self.arrays):
+            selected = parts == part
+            if not selected.any():
+                continue
+            part_indices = indices[selected] - self._offsets[part]
+            for value, array in zip(values, arrays.values()):
+                value[selected] = array[part_indices]
+        return values
+
+    def dataset(
+            self, indices=None, shuffle=False, chunk_size=256, seed=None):
+        """
+        An infinitely repeated dataset of (image, label, bbox, count,
+        bbox_label, text) tuples, read in chunks of `chunk_size` examples
+        from the memory-mapped arrays.
+        """
+        if indices is None:
+            indices = np.arange(self.num_examples)
+        dataset = tf.data.Dataset.from_tensor_slices(indices)
+        if shuffle:
+            dataset = dataset.shuffle(buffer_size=len(indices), seed=seed)
+        dataset = dataset.repeat().batch(chunk_size)
+        dtypes = [tf.as_dtype(t) for t in self.columns.values()]
+        shapes = [a.shape[1:] for a in self.arrays[0].values()]
+
+        def gather(indices):
+            values = tf.py_func(self._gather, [indices], dtypes)
+            for value, shape in zip(values, shapes):
+                value.set_shape((None, ) + shape)
+            return tuple(values)
+
+        def reorder(image, label, bbox, bbox_label, count):
+            return image, label, bbox, count, bbox_label, tf.constant('')
+
+        dataset = dataset.map(gather)
+        dataset = dataset.apply(tf.contrib.data.unbatch())
+        return dataset.map(reorder)
+
+
+def pack(files, path, shape, parse_proto, batch_size=256):
+    """
+    Converts TFRecord `files` into a packed dataset in the directory `path`,
+    where images are decoded and resized to `shape`.
+    """
+    num_examples = sum(
+        1 for f in files for _ in tf.python_io.tf_record_iterator(f))
+    log.info(
+        'Packing {} examples from {} files into {!r}...'
+        .format(num_examples, len(files), path))
+    height, width, channels = shape
+
+    def decode(serialized):
+        encoded, label, bbox, count, bbox_label, _ = parse_proto(serialized)
+        image = tf.image.decode_jpeg(encoded, channels=channels)
+        image = tf.image.resize_images(image, [height, width])
+        image = tf.cast(tf.round(image), tf.uint8)
+        return image, label, bbox, bbox_label, count
+
+    graph = tf.Graph()
+    with graph.as_default():
+        dataset = tf.data.TFRecordDataset(files).map(decode)
+        batch = dataset.batch(batch_size).make_one_shot_iterator().get_next()
+    os.makedirs(path, exist_ok=True)
+    arrays = []
+    for (name, dtype), tensor in zip(PackedDataset.columns.items(), batch):
+        array_shape = (num_examples, ) + tuple(tensor.shape.as_list()[1:])
+        arrays.append(np.lib.format.open_memmap(
+            os.path.join(path, '{}.npy'.format(name)),
+            mode='w+', dtype=dtype, shape=array_shape))
+    with tf.Session(graph=graph) as session:
+        index = 0
+        while True:
+            try:
+                values = session.run(batch)
+            except tf.errors.OutOfRangeError:
+                break
+            size = len(values[0])
+            for array, value in zip(arrays, values):
+                array[index:index + size] = value
+            index += size
+            log.info(
+                'Packed {}/{} examples...'.format(index, num_examples),
+                update=True)
+    for array in arrays:
+        array.flush()
+    log.info('Packed dataset saved in {!r}.'.format(path))
@@ -3,11 +3,18 @@ import os
 from importlib.util import spec_from_file_location, module_from_spec
 
 
-root = os.path.dirname(__file__)
-if root == '.':
-    root = ''
-path = os.path.join(root, 'mayo', 'cli.py')
-spec = spec_from_file_location('cli', path)
-cli = module_from_spec(spec)
-spec.loader.exec_module(cli)
-cli.CLI().main()
+def main():
+    root = os.path.dirname(__file__)
+    if root == '.':
+        root = ''
+    path = os.path.join(root, 'mayo', 'cli.py')
+    spec = spec_from_file_location('cli', path)
+    cli = module_from_spec(spec)
+    spec.loader.exec_module(cli)
+    cli.CLI().main()
+
+
+# worker processes spawned by the search import this module again,
+# and must not run the command line interface
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+from common import TestCase
+
+import numpy as np
+
+from mayo.task.image.classify import StreamingAccuracy
+
+
+class TestStreamingAccuracy(TestCase):
+    def test_accuracy(self):
+        num_examples, batch_size = 10, 4
+        corrects = np.array([1, 0, 1, 1, 0, 0, 1, 1, 1, 0], dtype=float)
+        accuracy = StreamingAccuracy()
+        num_batches = -(-num_examples // batch_size)
+        for step in range(num_batches):
+            # the final batch wraps around to the start of the dataset
+            indices = np.arange(step * batch_size, (step + 1) * batch_size)
+            accuracy.add(corrects[indices % num_examples])
+        num_remaining = num_examples % batch_size
+        self.assertAlmostEqual(
+            accuracy.accuracy(num_remaining), np.mean(corrects))
+        # all examples of all batches when not trimmed
+        wrapped = np.concatenate([corrects, corrects[:2]])
+        self.assertAlmostEqual(accuracy.accuracy(), np.mean(wrapped))
+
+    def test_exact_batches(self):
+        corrects = np.array([1, 0, 0, 1, 1, 1], dtype=float)
+        accuracy = StreamingAccuracy()
+        for batch in np.split(corrects, 3):
+            accuracy.add(batch)
+        # no remainder, so the final batch is complete
+        self.assertAlmostEqual(accuracy.accuracy(0), np.mean(corrects))
+
+    def test_reset(self):
+        accuracy = StreamingAccuracy()
+        accuracy.add(np.ones(4))
+        accuracy.reset()
+        self.assertEqual(accuracy.accuracy(), 0)
+        accuracy.add(np.array([1, 0]))
+        self.assertAlmostEqual(accuracy.accuracy(), 0.5)
@@ -0,0 +1,48 @@
+from common import TestCase
+
+import numpy as np
+
+from mayo.task.image.detect import util
+
+
+class TestDetectionEval(TestCase):
+    def test_iou_matrix(self):
+        corners1 = np.array([[0, 0, 2, 2]], dtype=float)
+        corners2 = np.array(
+            [[0, 0, 2, 2], [1, 1, 3, 3], [2, 2, 3, 3]], dtype=float)
+        iou = util.np_iou_matrix(corners1, corners2)
+        # identical, intersection 1 over union 7, and touching only
+        self.assertSequenceEqual(iou.shape, (1, 3))
+        np.testing.assert_allclose(iou[0], [1, 1 / 7, 0])
+
+    def test_match_detections(self):
+        box = [0, 0, 2, 2]
+        corners = np.array([box, box, box, [5, 5, 6, 6]], dtype=float)
+        classes = np.array([0, 0, 1, 0])
+        scores = np.array([0.9, 0.8, 0.95, 0.7])
+        truth_corners = np.array([box], dtype=float)
+        truth_classes = np.array([0])
+        true_pos = util.np_match_detections(
+            corners, classes, scores, truth_corners, truth_classes, 0.5)
+        # the second match of the same box, the detection of the wrong
+        # class and the detection without overlap are false positives
+        self.assertSequenceEqual(
+            list(true_pos), [True, False, False, False])
+
+    def test_match_without_truths(self):
+        true_pos = util.np_match_detections(
+            np.zeros([2, 4]), np.zeros(2, dtype=int), np.ones(2),
+            np.zeros([0, 4]), np.zeros(0, dtype=int), 0.5)
+        self.assertSequenceEqual(list(true_pos), [False, False])
+
+    def test_average_precisions(self):
+        scores = np.array([0.8, 0.9, 0.7])
+        classes = np.array([0, 0, 0])
+        true_pos = np.array([False, True, True])
+        # class 1 has no truths and is skipped, class 2 has no detections
+        num_truths = np.array([2, 0, 1])
+        avg_precisions = util.np_average_precisions(
+            scores, classes, true_pos, num_truths)
+        # in score order, recalls are [1/2, 1/2, 1] and precisions are
+        # [1, 1/2, 2/3], the envelope gives 1/2 * 1 + 1/2 * 2/3
+        np.testing.assert_allclose(avg_precisions, [5 / 6, 0])
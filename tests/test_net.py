@@ -3,6 +3,7 @@ from common import TestCase
 import types
 import itertools
 
+import numpy as np
 import networkx as nx
 import tensorflow as tf
 from tensorflow.contrib import slim
@@ -10,7 +11,9 @@ from tensorflow.contrib import slim
 from mayo.config import Config
 from mayo.net.graph import Graph, TensorNode, LayerNode, JoinNode
 from mayo.net.base import NetBase
+from mayo.net.compact import ChannelCompactor
 from mayo.net.tf import TFNet
+from mayo.net.tf.sparse import SparseWeights
 from mayo.net.tf.transform import ParameterTransformer
 from mayo.override import FixedPointQuantizer
 
@@ -245,6 +248,139 @@ class TestNetBase(TestCase):
         self.assertSequenceEqual(output.shape, [2, 6])
 
 
+class TestChannelCompactor(TestCase):
+    class Net(NetBase):
+        # tensors are represented by their shapes
+        def shapes(self, unified=True):
+            return self._tensors
+
+        def instantiate_convolution(self, node, shape, params):
+            return shape[:-1] + (params['num_outputs'], )
+
+        def instantiate_add(self, node, shapes, params):
+            return shapes[0]
+
+        def instantiate_squeeze(self, node, shape, params):
+            return (shape[0], shape[-1])
+
+        def instantiate_activation(self, node, shape, params):
+            return shape
+
+        instantiate_fully_connected = instantiate_convolution
+        instantiate_batch_normalization = instantiate_activation
+
+    def setUp(self):
+        conv = {'type': 'convolution', 'num_outputs': 4}
+        self.model = {
+            'name': 'test',
+            'layers': {
+                'conv0': conv,
+                'conv1': conv,
+                'add': {'type': 'add'},
+                'squeeze': {'type': 'squeeze', 'axis': [1, 2]},
+                'logits': {'type': 'fully_connected', 'num_outputs': 2},
+            },
+            'graph': [
+                {'from': 'input', 'with': 'conv0', 'to': 'a'},
+                {'from': 'a', 'with': 'conv1', 'to': 'b'},
+                {'from': ['a', 'b'], 'with': 'add', 'to': 'c'},
+                {
+                    'from': 'c', 'with': ['squeeze', 'logits'],
+                    'to': 'output'
+                },
+            ],
+        }
+        self.net = self.Net(self.model, {'input': (1, 8, 8, 3)})
+        self.nodes = {n.name: n for n in self.net._graph.layer_nodes()}
+        masks = {
+            self.nodes['conv0']: np.array([True, False, True, False]),
+            self.nodes['conv1']: np.array([True, True, False, False]),
+        }
+        self.compactor = ChannelCompactor(self.net, masks)
+
+    def test_kept(self):
+        # channels added together keep the union of their masks
+        in_kept, out_kept = self.compactor.kept[self.nodes['conv1']]
+        self.assertSequenceEqual(list(in_kept), [0, 1, 2])
+        self.assertSequenceEqual(list(out_kept), [0, 1, 2])
+        # outputs keep all channels
+        in_kept, out_kept = self.compactor.kept[self.nodes['logits']]
+        self.assertSequenceEqual(list(in_kept), [0, 1, 2])
+        self.assertIsNone(out_kept)
+
+    def test_compact_values(self):
+        values = {
+            'test/conv1/weights': np.ones([3, 3, 4, 4]),
+            'test/conv1/biases': np.arange(4),
+            'test/logits/weights': np.ones([4, 2]),
+        }
+        values = self.compactor.compact_values(values)
+        self.assertSequenceEqual(
+            values['test/conv1/weights'].shape, [3, 3, 3, 3])
+        self.assertSequenceEqual(list(values['test/conv1/biases']), [0, 1, 2])
+        self.assertSequenceEqual(values['test/logits/weights'].shape, [3, 2])
+
+    def test_compact_model(self):
+        model = self.compactor.compact_model(self.model)
+        layers = model['layers']
+        self.assertEqual(layers['conv0']['num_outputs'], 3)
+        self.assertEqual(layers['conv1']['num_outputs'], 3)
+        self.assertEqual(layers['logits']['num_outputs'], 2)
+        # the original definition is unchanged
+        self.assertEqual(self.model['layers']['conv0']['num_outputs'], 4)
+
+    @staticmethod
+    def _forward(inputs, values, mask=1):
+        # conv0 -> bn -> relu -> conv1 with 1x1 kernels
+        outputs = np.dot(inputs, values['test/conv0/weights'][0, 0])
+        outputs = (outputs + values['test/conv0/biases']) * mask
+        deviation = np.sqrt(values['test/bn/moving_variance'] + 0.001)
+        outputs -= values['test/bn/moving_mean']
+        outputs = values['test/bn/gamma'] * outputs / deviation
+        outputs = np.maximum(outputs + values['test/bn/beta'], 0)
+        outputs = np.dot(outputs, values['test/conv1/weights'][0, 0])
+        return outputs + values['test/conv1/biases']
+
+    def test_fold_constants(self):
+        conv = {
+            'type': 'convolution', 'kernel_size': 1, 'activation_fn': None}
+        model = {
+            'name': 'test',
+            'layers': {
+                'conv0': dict(conv, num_outputs=4),
+                'bn': {'type': 'batch_normalization', 'scale': True},
+                'relu': {'type': 'activation', 'mode': 'relu'},
+                'conv1': dict(conv, num_outputs=2),
+            },
+            'graph': {
+                'from': 'input', 'with': ['conv0', 'bn', 'relu', 'conv1'],
+                'to': 'output',
+            },
+        }
+        net = self.Net(model, {'input': (1, 2, 2, 3)})
+        nodes = {n.name: n for n in net._graph.layer_nodes()}
+        mask = np.array([True, False, True, False])
+        compactor = ChannelCompactor(net, {nodes['conv0']: mask})
+        values = {
+            'test/conv0/weights': np.random.normal(size=[1, 1, 3, 4]),
+            'test/conv0/biases': np.random.normal(size=4),
+            'test/bn/gamma': np.random.uniform(0.5, 2, size=4),
+            # pruned channels give positive constants after relu
+            'test/bn/beta': np.random.uniform(1, 2, size=4),
+            'test/bn/moving_mean': np.random.normal(size=4),
+            'test/bn/moving_variance': np.random.uniform(0.5, 2, size=4),
+            'test/conv1/weights': np.random.normal(size=[1, 1, 4, 2]),
+            'test/conv1/biases': np.random.normal(size=2),
+        }
+        compacted = compactor.compact_values(values)
+        self.assertSequenceEqual(
+            compacted['test/conv1/weights'].shape, [1, 1, 2, 2])
+        inputs = np.random.normal(size=[1, 2, 2, 3])
+        np.testing.assert_allclose(
+            self._forward(inputs, compacted),
+            self._forward(inputs, values, mask))
+
+
 class TestTFNet(TestCase):
     class Net(TFNet):
         def instantiate_variable(self, node, tensor, params):
@@ -279,3 +415,47 @@ class TestTFNet(TestCase):
         net = TFNet(config.model, images, None, 10, False, False)
         logits = net.logits()
         self.assertSequenceEqual(logits.shape, [1, 10])
+
+
+class TestSparseWeights(TestCase):
+    max_density = 0.3
+
+    def _weights(self, shape, density):
+        weights = np.random.normal(size=shape).astype(np.float32)
+        return weights * (np.random.rand(*shape) < density)
+
+    def _assert_outputs_match(self, weights, inputs, func, dense_func):
+        with tf.Graph().as_default(), tf.Session() as session:
+            weights_var = tf.Variable(weights)
+            sparse_weights = SparseWeights(weights_var, self.max_density)
+            outputs = func(tf.constant(inputs), sparse_weights)
+            expected = dense_func(tf.constant(inputs), weights_var)
+            session.run(weights_var.initializer)
+            op, feed_dict = sparse_weights.feed(session.run(weights_var))
+            session.run(op, feed_dict=feed_dict)
+            is_sparse, outputs, expected = session.run(
+                [sparse_weights.is_sparse, outputs, expected])
+        self.assertEqual(outputs.shape, expected.shape)
+        np.testing.assert_allclose(outputs, expected, rtol=1e-4, atol=1e-4)
+        return is_sparse
+
+    def test_fully_connected(self):
+        inputs = np.random.normal(size=[3, 20]).astype(np.float32)
+        for density, sparse in ((0.2, True), (1, False)):
+            weights = self._weights([20, 7], density)
+            is_sparse = self._assert_outputs_match(
+                weights, inputs, lambda x, w: w.matmul(x), tf.matmul)
+            self.assertEqual(is_sparse, sparse)
+
+    def test_convolution(self):
+        inputs = np.random.normal(size=[2, 9, 9, 4]).astype(np.float32)
+        configs = itertools.product(
+            ((0.2, True), (1, False)), ([1, 1], [2, 2]), ('SAME', 'VALID'))
+        for (density, sparse), stride, padding in configs:
+            weights = self._weights([3, 3, 4, 5], density)
+            is_sparse = self._assert_outputs_match(
+                weights, inputs,
+                lambda x, w: w.conv2d(x, stride, padding),
+                lambda x, w: tf.nn.conv2d(
+                    x, w, [1] + stride + [1], padding))
+            self.assertEqual(is_sparse, sparse)
@@ -1,8 +1,11 @@
 from common import TestCase
 
+import numpy as np
 import tensorflow as tf
 
+from mayo.override import util
 from mayo.override.base import OverriderBase, Parameter
+from mayo.session.checkpoint import CheckpointHandler
 
 
 class VariableMock(object):
@@ -54,3 +57,73 @@ class TestParameter(TestCase):
         expect_var = VariableMock(
             'scope/Overrider.test', (), var.initializer, tf.int32, True)
         self.assertObjectEqual(var, expect_var)
+
+
+class TestSelection(TestCase):
+    def test_kth_smallest(self):
+        values = np.random.permutation(100).astype(np.float32)
+        for k in (0, 17, 99, -1, -10):
+            self.assertEqual(util.kth_smallest(values, k), sorted(values)[k])
+
+    def test_kth_smallest_global(self):
+        values = [np.random.rand(10), np.random.rand(3, 5), np.random.rand(1)]
+        flat = sorted(np.concatenate([v.flatten() for v in values]))
+        for k in (0, 12, -1):
+            self.assertEqual(util.kth_smallest(values, k), flat[k])
+
+
+class TestBitPacking(TestCase):
+    sizes = (1, 7, 8, 13, 20)
+
+    def _mask(self, size):
+        return np.random.rand(size) > 0.5
+
+    def test_round_trip(self):
+        for size in self.sizes:
+            mask = self._mask(size)
+            packed = util.pack_bits(mask)
+            self.assertEqual(packed.shape, (-(-size // 8), ))
+            unpacked = util.unpack_bits(packed, [size])
+            np.testing.assert_array_equal(unpacked, mask)
+
+    def test_round_trip_shape(self):
+        mask = self._mask(3 * 5).reshape(3, 5)
+        unpacked = util.unpack_bits(util.pack_bits(mask), [3, 5])
+        np.testing.assert_array_equal(unpacked, mask)
+
+    def test_round_trip_tensor(self):
+        masks = [self._mask(size) for size in self.sizes]
+        with tf.Graph().as_default(), tf.Session() as session:
+            packed = [util.pack_bits(tf.constant(m)) for m in masks]
+            unpacked = [
+                util.unpack_bits(p, [m.size]) for p, m in zip(packed, masks)]
+            packed, unpacked = session.run([packed, unpacked])
+        for mask, p, u in zip(masks, packed, unpacked):
+            # identical to numpy packing, including padded bits
+            np.testing.assert_array_equal(p, np.packbits(mask))
+            np.testing.assert_array_equal(u, mask)
+
+    def test_count_bits(self):
+        for size in self.sizes:
+            mask = self._mask(size)
+            # padded bits are set and must not be counted
+            packed = np.packbits(np.concatenate([mask, np.ones(7, bool)]))
+            packed = packed[:-(-size // 8)]
+            self.assertEqual(
+                util.count_bits(packed, size), np.count_nonzero(mask))
+
+    def test_checkpoint_conversion(self):
+        mask = self._mask(3 * 5).reshape(3, 5)
+        converter = CheckpointHandler._mask_converter
+        with tf.Graph().as_default():
+            packed = tf.Variable(
+                tf.zeros([2], tf.uint8), name='conv/Pruner.mask')
+            dense = tf.Variable(
+                tf.zeros([3, 5], tf.bool), name='fc/Pruner.mask')
+            other = tf.Variable(tf.zeros([2], tf.uint8), name='fc/other')
+            pack = converter(packed, (3, 5), tf.bool)
+            unpack = converter(dense, (2, ), tf.uint8)
+            self.assertIsNone(converter(packed, (2, ), tf.uint8))
+            self.assertIsNone(converter(other, (3, 5), tf.bool))
+        np.testing.assert_array_equal(pack(mask), np.packbits(mask))
+        np.testing.assert_array_equal(unpack(np.packbits(mask)), mask)
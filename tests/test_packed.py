@@ -0,0 +1,33 @@
+from common import TestCase
+
+import os
+import tempfile
+
+import numpy as np
+
+from mayo.task.image.packed import PackedDataset
+
+
+class TestPackedDataset(TestCase):
+    def _pack(self, directory, labels):
+        os.makedirs(directory)
+        num_examples = len(labels)
+        arrays = {
+            'images': np.zeros([num_examples, 2, 2, 3], dtype=np.uint8),
+            'labels': np.array(labels, dtype=np.int32),
+            'bboxes': np.zeros([num_examples, 1, 4], dtype=np.float32),
+            'bbox_labels': np.zeros([num_examples, 1], dtype=np.int32),
+            'bbox_counts': np.zeros(num_examples, dtype=np.int32),
+        }
+        for name, array in arrays.items():
+            np.save(os.path.join(directory, '{}.npy'.format(name)), array)
+
+    def test_multiple_directories(self):
+        with tempfile.TemporaryDirectory() as path:
+            paths = [os.path.join(path, name) for name in ('a', 'b')]
+            self._pack(paths[0], [0, 1, 2])
+            self._pack(paths[1], [3, 4])
+            packed = PackedDataset(paths)
+            self.assertEqual(packed.num_examples, 5)
+            _, labels, *_ = packed._gather(np.array([4, 0, 3, 2]))
+            self.assertSequenceEqual(list(labels), [4, 0, 3, 2])
@@ -0,0 +1,54 @@
+from common import TestCase
+
+import types
+
+import numpy as np
+import tensorflow as tf
+
+from mayo.session.base import SessionBase
+from mayo.net.tf.sparse import SparseWeights
+
+
+class TestSparseWeightsRestore(TestCase):
+    class Session(SessionBase):
+        def __init__(self, sparse_weights):
+            # only the states used to snapshot and restore variables
+            self.tf_graph = tf.get_default_graph()
+            self.tf_session = tf.Session(graph=self.tf_graph)
+            self.initialized_variables = []
+            self.initialized_iterators = []
+            self._num_checked_variables = 0
+            self._assign_operators = {}
+            self._assign_groups = {}
+            self._assign_values = {}
+            self._dirty_overriders = []
+            self._update_overriders = []
+            net = types.SimpleNamespace(
+                sparse_layers={'fc': {'weights': sparse_weights}})
+            self.task = types.SimpleNamespace(nets=[net])
+
+        def __del__(self):
+            self.tf_session.close()
+
+    def test_restore_checkpoints(self):
+        weights = np.random.normal(size=[20, 7]).astype(np.float32)
+        inputs = np.random.normal(size=[3, 20]).astype(np.float32)
+        # two checkpoints with different masks
+        masks = [np.random.rand(20, 7) < 0.2 for _ in range(2)]
+        with tf.Graph().as_default():
+            weights_var = tf.Variable(weights)
+            mask_var = tf.Variable(masks[0])
+            masked = weights_var * tf.cast(mask_var, tf.float32)
+            sparse_weights = SparseWeights(masked, 0.3)
+            outputs = sparse_weights.matmul(tf.constant(inputs))
+            session = self.Session(sparse_weights)
+            snapshots = []
+            for mask in masks:
+                session.restore_variables({mask_var: mask})
+                snapshots.append(session.snapshot_variables())
+            # evaluate each checkpoint in turn, as `eval_multiple` does
+            for mask, snapshot in zip(masks, snapshots):
+                session.restore_variables(snapshot)
+                np.testing.assert_allclose(
+                    session.run(outputs), np.dot(inputs, weights * mask),
+                    rtol=1e-4, atol=1e-4)